@@ -1,16 +1,20 @@
+import logging
+
 from flask_socketio import SocketIO
 from engineio.async_drivers import gevent
 from flask import Flask
 from sqlalchemy.orm import scoped_session
 import bija.db as db
-from bija.args import args
+from bija.args import args, LOGGING_LEVEL
 
 
 app = Flask(__name__, template_folder='../bija/templates')
 socketio = SocketIO(app)
 app.session = scoped_session(db.DB_SESSION)
+app.read_session = scoped_session(db.DB_READ_SESSION)
 app.jinja_env.trim_blocks = True
 app.jinja_env.lstrip_blocks = True
+logging.getLogger('bija.http_client').setLevel(LOGGING_LEVEL)
 
 from bija.routes import *
 
@@ -1,6 +1,7 @@
 import argparse
 import logging
 
+from bija.config import DB_PROFILES, DEFAULT_DB_PROFILE
 from bija.setup import setup
 
 SETUP_PK = None
@@ -16,6 +17,13 @@ parser.add_argument("-d", "--debug", dest="debug", help="When set debug messages
 parser.add_argument("-p", "--port", dest="port", help="Set the port,  default is 5000", default=5000, type=int)
 parser.add_argument("-db", "--db", dest="db", help="Set the database - eg. {name}.sqlite,  default is bija",
                     default='bija', type=str)
+parser.add_argument("--db-profile", dest="db_profile",
+                    help="SQLite tuning profile: safe, balanced or fast, default is {}".format(DEFAULT_DB_PROFILE),
+                    default=DEFAULT_DB_PROFILE, choices=DB_PROFILES.keys())
+parser.add_argument("--db-cache-size", dest="db_cache_size",
+                    help="Override the SQLite page cache size of the profile (KiB)", default=None, type=int)
+parser.add_argument("--db-mmap-size", dest="db_mmap_size",
+                    help="Override the SQLite memory map size of the profile (MiB)", default=None, type=int)
 
 args = parser.parse_args()
 
@@ -1,3 +1,5 @@
+import os
+
 DEFAULT_RELAYS = [
     'wss://nostr.drss.io',
     'wss://nostr-pub.wellorder.net',
@@ -5,4 +7,94 @@ DEFAULT_RELAYS = [
     'wss://nostr.bitcoiner.social',
     'wss://nostr-pub.semisol.dev',
     'wss://relay.damus.io	'
-]
\ No newline at end of file
+]
+
+# incoming events are stored in batches, one transaction per batch
+# both can be overridden from the settings page
+INGEST_BATCH_SIZE = 200
+INGEST_FLUSH_MS = 500
+
+# number of recently processed event ids kept in memory to reject duplicates from other relays
+SEEN_EVENTS_SIZE = 50000
+
+# threads used to check ids and signatures of incoming events
+VERIFY_WORKERS = min(4, os.cpu_count() or 1)
+
+# sqlite connection settings, selected with --db-profile
+# cache_size is in KiB, mmap_size in bytes
+DB_PROFILES = {
+    'safe': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'cache_size': 2000,
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT'
+    },
+    'balanced': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': 64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY'
+    },
+    'fast': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': 256000,
+        'mmap_size': 1024 * 1024 * 1024,
+        'temp_store': 'MEMORY'
+    }
+}
+DEFAULT_DB_PROFILE = 'balanced'
+DB_BUSY_TIMEOUT_MS = 5000
+
+# maximum number of queued write jobs applied in one transaction by the db writer
+WRITER_BATCH_SIZE = 100
+# read only connections used for rendering pages
+DB_READ_POOL_SIZE = 8
+# profile names and avatars kept in memory for rendering notes
+PROFILE_BRIEFS_SIZE = 5000
+# last stored metadata timestamp per pubkey, used to drop outdated kind-0 events without a query
+PROFILE_VERSIONS_SIZE = 50000
+# processed note content and media fragments kept in memory
+NOTE_HTML_CACHE_SIZE = 5000
+# link preview fetching
+OG_FETCH_WORKERS = 4
+# requests per second across all workers
+OG_FETCH_RATE = 5
+# fetches handed to the workers but not finished yet, the rest wait in the task queue
+OG_FETCH_MAX_PENDING = 64
+# previews are written back to notes when this many are ready or after OG_WRITE_INTERVAL seconds
+OG_WRITE_BATCH_SIZE = 20
+OG_WRITE_INTERVAL = 2
+# seconds before a cached link preview is fetched again
+OG_CACHE_TTL = 60 * 60 * 24 * 7
+# seconds before a url that gave no preview is retried, and how many times
+OG_NEGATIVE_TTL = 60 * 60 * 6
+OG_MAX_ATTEMPTS = 4
+# link previews only read the page head, up to this many bytes, in chunks
+OG_MAX_BYTES = 256 * 1024
+OG_READ_CHUNK = 16 * 1024
+# seconds a preview fetch may take in total, each read also has the HTTP_TIMEOUT
+OG_READ_DEADLINE = 10
+OG_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+# nip-05 lookups
+NIP05_WORKERS = 4
+# identifiers kept in memory, lookups expire after the ttls below
+NIP05_CACHE_SIZE = 20000
+NIP05_CACHE_TTL = 60 * 60 * 6
+NIP05_NEGATIVE_TTL = 60 * 30
+# requests for the same domain arriving within this many seconds share one fetch
+NIP05_BATCH_DELAY = 0.5
+# outbound http, shared by nip-05 lookups, relay info and link previews
+# hosts kept in the connection pool and idle connections kept per host
+HTTP_POOL_HOSTS = 32
+HTTP_POOL_SIZE = 4
+# requests running at once, overall and per host
+HTTP_MAX_ACTIVE = 16
+HTTP_PER_HOST = 2
+HTTP_TIMEOUT = 2
+HTTP_MAX_BYTES = 1024 * 1024
+HTTP_DNS_TTL = 60 * 5
+# recent requests kept for the latency percentiles
+HTTP_LATENCY_SAMPLES = 500
@@ -1,31 +1,210 @@
 import json
+import threading
 import time
+from contextlib import contextmanager
 
-from sqlalchemy import create_engine, text, func, or_
+from sqlalchemy import create_engine, text, func, or_, event, tuple_, bindparam, select, union, case
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker, aliased
 from sqlalchemy.sql import label
-from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.pool import SingletonThreadPool, QueuePool
 
 from bija.args import args
+from bija.config import DB_PROFILES, DB_BUSY_TIMEOUT_MS, DB_READ_POOL_SIZE
+from bija.migrations import Migrator, MIGRATIONS
 from bija.models import *
+from bija.note_html import NOTE_HTML
+from bija.profile_briefs import PROFILE_BRIEFS
+from bija.profile_versions import PROFILE_VERSIONS, ProfileVersion, NO_PROFILE
+
 DB_ENGINE = create_engine("sqlite:///{}.sqlite".format(args.db), echo=False, poolclass=SingletonThreadPool, pool_size=10)
+# read only connections shared by page requests, all writes go through the db writer (see db_writer.py)
+DB_READ_ENGINE = create_engine("sqlite:///file:{}.sqlite?mode=ro&uri=true".format(args.db), echo=False,
+                               poolclass=QueuePool, pool_size=DB_READ_POOL_SIZE, max_overflow=DB_READ_POOL_SIZE,
+                               connect_args={'check_same_thread': False})
+
+
+def db_profile():
+    profile = dict(DB_PROFILES[args.db_profile])
+    if args.db_cache_size is not None:
+        profile['cache_size'] = args.db_cache_size
+    if args.db_mmap_size is not None:
+        profile['mmap_size'] = args.db_mmap_size * 1024 * 1024
+    return profile
+
+
+DB_PROFILE = db_profile()
+
+
+def apply_pragmas(dbapi_connection, read_only=False):
+    profile = DB_PROFILE
+    cursor = dbapi_connection.cursor()
+    if not read_only:
+        cursor.execute("PRAGMA journal_mode={}".format(profile['journal_mode']))
+        cursor.execute("PRAGMA synchronous={}".format(profile['synchronous']))
+    cursor.execute("PRAGMA cache_size=-{}".format(profile['cache_size']))
+    cursor.execute("PRAGMA mmap_size={}".format(profile['mmap_size']))
+    cursor.execute("PRAGMA temp_store={}".format(profile['temp_store']))
+    cursor.execute("PRAGMA busy_timeout={}".format(DB_BUSY_TIMEOUT_MS))
+    cursor.close()
+
+
+# applied to every new connection
+@event.listens_for(DB_ENGINE, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    apply_pragmas(dbapi_connection)
+
+
+@event.listens_for(DB_READ_ENGINE, "connect")
+def set_sqlite_read_pragmas(dbapi_connection, connection_record):
+    apply_pragmas(dbapi_connection, read_only=True)
+
+
 DB_SESSION = sessionmaker(autocommit=False, autoflush=False, bind=DB_ENGINE)
+DB_READ_SESSION = sessionmaker(autocommit=False, autoflush=False, bind=DB_READ_ENGINE)
+MIGRATOR = Migrator(DB_ENGINE, DB_SESSION, MIGRATIONS)
+
+# columns selected for notes that are rendered in feeds and threads, each one is read by the note templates
+# or by FeedThread/NoteThread, rows come back as plain Row tuples
+NOTE_COLUMNS = [
+    Note.id,
+    Note.public_key,
+    Note.content,
+    Note.response_to,
+    Note.thread_root,
+    Note.reshare,
+    Note.created_at,
+    Note.members,
+    Note.media,
+    Note.liked,
+    Note.deleted,
+    ReactionTally.likes,
+    ReactionTally.replies,
+    ReactionTally.shares,
+    Profile.name,
+    Profile.pic,
+    Profile.nip05,
+    Profile.nip05_validated,
+    Profile.following
+]
+
+
+def keyset_before(created_at, note_id=None, created_at_column=Note.created_at, id_column=Note.id):
+    if note_id is None:
+        return created_at_column < created_at
+    return tuple_(created_at_column, id_column) < tuple_(created_at, note_id)
+
+
+# ids of the note, its replies all the way down and its chain of parents up to the thread root
+# both recursions carry only ids, so UNION drops every note already visited and each is walked once,
+# notes that name the note as their thread root come from a plain index lookup
+def thread_ids(note_id):
+    down = select(Note.id).where(Note.id == note_id).cte('thread_down', recursive=True)
+    down = down.union(select(Note.id).join(down, Note.response_to == down.c.id))
+
+    up = select(Note.id, Note.response_to, Note.thread_root) \
+        .where(Note.id == note_id) \
+        .cte('thread_up', recursive=True)
+    up = up.union(
+        select(Note.id, Note.response_to, Note.thread_root)
+        .join(up, Note.id == func.coalesce(up.c.response_to, up.c.thread_root)))
+
+    return union(select(down.c.id), select(up.c.id), select(Note.id).where(Note.thread_root == note_id))
 
 
 class BijaDB:
 
+    # per thread batch depth, while > 0 writes are flushed but not committed
+    batch_state = threading.local()
+    schema_ready = False
+
     def __init__(self, session):
 
         self.session = session
-        Base.metadata.create_all(DB_ENGINE)
+        if not BijaDB.schema_ready:
+            Base.metadata.create_all(DB_ENGINE)
+            MIGRATOR.run()
+            BijaDB.schema_ready = True
+
+    # one chunk of any pending migration backfill, True while there is more to do
+    def run_backfill_step(self):
+        more = MIGRATOR.backfill_step(self.session)
+        self.commit_or_flush()
+        return more
+
+    def in_batch(self):
+        return getattr(self.batch_state, 'depth', 0) > 0
+
+    # group all writes made in the block into a single transaction
+    @contextmanager
+    def batch(self):
+        depth = getattr(self.batch_state, 'depth', 0)
+        if depth == 0:
+            self.batch_state.tallies = {}
+            self.batch_state.changed_profiles = set()
+            self.batch_state.changed_notes = set()
+            self.batch_state.profiles = {}
+        self.batch_state.depth = depth + 1
+        try:
+            yield self
+            if depth == 0:
+                self.apply_tally_deltas(self.batch_state.tallies)
+                self.apply_profile_updates(list(self.batch_state.profiles.values()))
+                self.session.commit()
+                self.drop_cached(self.batch_state.changed_profiles, self.batch_state.changed_notes)
+                self.remember_profile_versions(self.batch_state.profiles.values())
+        except Exception:
+            if depth == 0:
+                self.session.rollback()
+            raise
+        finally:
+            self.batch_state.depth = depth
+            if depth == 0:
+                self.batch_state.tallies = {}
+                self.batch_state.changed_profiles = set()
+                self.batch_state.changed_notes = set()
+                self.batch_state.profiles = {}
+
+    def commit_or_flush(self):
+        if self.in_batch():
+            self.session.flush()
+        else:
+            self.session.commit()
+
+    # cached profile briefs and note html are dropped once the change is committed so readers can't re-cache the old row
+    def profile_changed(self, public_key):
+        if self.in_batch():
+            self.batch_state.changed_profiles.add(public_key)
+        else:
+            self.drop_cached([public_key], [])
+
+    def note_changed(self, note_id):
+        if self.in_batch():
+            self.batch_state.changed_notes.add(note_id)
+        else:
+            self.drop_cached([], [note_id])
+
+    @staticmethod
+    def drop_cached(public_keys, note_ids):
+        if len(public_keys) > 0:
+            PROFILE_BRIEFS.discard(public_keys)
+            PROFILE_VERSIONS.discard(public_keys)
+            NOTE_HTML.discard_profiles(public_keys)
+        if len(note_ids) > 0:
+            NOTE_HTML.discard_notes(note_ids)
 
     def reset(self):
         self.session.query(Profile).delete()
         self.session.query(PrivateMessage).delete()
         self.session.query(Note).delete()
+        self.session.query(Timeline).delete()
+        self.session.query(Contact).delete()
         self.session.query(PK).delete()
-        self.session.commit()
+        self.commit_or_flush()
+        PROFILE_BRIEFS.clear()
+        PROFILE_VERSIONS.clear()
+        NOTE_HTML.clear()
 
     def get_relays(self):
         return self.session.query(Relay)
@@ -34,11 +213,11 @@ class BijaDB:
         self.session.add(Relay(
             name=url
         ))
-        self.session.commit()
+        self.commit_or_flush()
 
     def remove_relay(self, url):
         self.session.query(Relay).filter_by(name=url).delete()
-        self.session.commit()
+        self.commit_or_flush()
 
     def get_preferred_relay(self):
         return self.session.query(Relay).first()
@@ -58,38 +237,102 @@ class BijaDB:
             key=key,
             enc=enc
         ))
-        self.session.commit()
+        self.commit_or_flush()
 
     def add_profile(self, public_key):
         self.session.add(Profile(
             public_key=public_key
         ))
-        self.session.commit()
-
-    def add_contact_list(self, public_key, keys: list):
-        self.session.merge(Profile(
-            public_key=public_key,
-            contacts=json.dumps(keys)
-        ))
-        self.session.commit()
-
+        self.commit_or_flush()
+
+    # store a contact list as edges in list order, only the keys added, removed or moved since the previous list
+    # are written
+    # returns the (added, removed) keys
+    def set_contacts(self, public_key, keys):
+        keys = {k: i for i, k in enumerate(dict.fromkeys(keys))}
+        current = {r.contact: r.position for r in self.session.query(Contact.contact, Contact.position)
+                   .filter(Contact.public_key == public_key).all()}
+        added = set(keys) - set(current)
+        removed = set(current) - set(keys)
+        changed = [k for k, i in keys.items() if current.get(k, -1) != i]
+        if len(changed) > 0:
+            stmt = sqlite_insert(Contact)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Contact.public_key, Contact.contact],
+                set_={'position': stmt.excluded.position}
+            )
+            self.session.execute(stmt, [
+                {'public_key': public_key, 'contact': k, 'position': keys[k]} for k in changed
+            ])
+        removed_list = list(removed)
+        for i in range(0, len(removed_list), 500):
+            self.session.query(Contact).filter(Contact.public_key == public_key) \
+                .filter(Contact.contact.in_(removed_list[i:i + 500])).delete(synchronize_session=False)
+        # a json list still waiting for the contacts backfill is now outdated
+        self.session.query(Profile).filter(Profile.public_key == public_key).filter(Profile.contacts.isnot(None)) \
+            .update({'contacts': None}, synchronize_session=False)
+        self.commit_or_flush()
+        return added, removed
+
+    def get_contacts(self, public_key):
+        return [r.contact for r in self.session.query(Contact.contact).filter(Contact.public_key == public_key)
+                .order_by(Contact.position).all()]
+
+    def get_contact_profiles(self, public_key):
+        return self.session.query(Profile).join(Contact, Contact.contact == Profile.public_key) \
+            .filter(Contact.public_key == public_key).order_by(Contact.position).all()
+
+    # one upsert for all the keys, profiles that don't exist yet are created
     def set_following(self, keys_list, following=True):
-        for public_key in keys_list:
-            self.session.merge(Profile(
-                public_key=public_key,
-                following=following
-            ))
-        self.session.commit()
+        keys_list = list(keys_list)
+        if len(keys_list) == 0:
+            return
+        self.session.flush()
+        stmt = sqlite_insert(Profile)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Profile.public_key],
+            set_={'following': stmt.excluded.following}
+        )
+        self.session.execute(stmt, [{'public_key': k, 'following': bool(following)} for k in keys_list])
+        if following:
+            self.add_authors_to_timeline(keys_list)
+        else:
+            self.remove_authors_from_timeline(keys_list)
+        self.commit_or_flush()
+
+    def add_authors_to_timeline(self, public_keys):
+        self.session.execute(text("""INSERT OR IGNORE INTO timeline (note_id, public_key, created_at)
+            SELECT id, public_key, created_at FROM note WHERE public_key IN :keys""").bindparams(
+            bindparam('keys', expanding=True)), {'keys': list(public_keys)})
+        self.commit_or_flush()
+
+    def remove_authors_from_timeline(self, public_keys):
+        self.session.query(Timeline).filter(Timeline.public_key.in_(list(public_keys))) \
+            .delete(synchronize_session=False)
+        self.commit_or_flush()
+
+    # add the note to the timeline if it's mine or from an account I follow
+    def add_to_timeline(self, note_id, public_key, created_at, my_public_key):
+        self.session.execute(text("""INSERT OR IGNORE INTO timeline (note_id, public_key, created_at)
+            SELECT :note_id, :public_key, :created_at
+            WHERE :public_key = :me
+            OR EXISTS (SELECT 1 FROM profile WHERE public_key = :public_key AND following = 1)"""), {
+            'note_id': note_id,
+            'public_key': public_key,
+            'created_at': created_at,
+            'me': my_public_key
+        })
+        self.commit_or_flush()
 
     def set_follower(self, public_key, follower=True):
         self.session.merge(Profile(
             public_key=public_key,
             follower=follower
         ))
-        self.session.commit()
+        self.commit_or_flush()
 
     def get_following_pubkeys(self):
-        keys = self.session.query(Profile).filter_by(following=1).all()
+        keys = self.session.query(Profile.public_key).filter_by(following=1).all()
         out = []
         for k in keys:
             out.append(k.public_key)
@@ -126,6 +369,7 @@ class BijaDB:
             out.append(dict(p))
         return out
 
+    # while a batch is open metadata updates wait in it and are written together when it's committed
     def upd_profile(self,
                     public_key,
                     name=None,
@@ -133,24 +377,136 @@ class BijaDB:
                     pic=None,
                     about=None,
                     updated_at=None,
-                    raw=None):
-        self.session.merge(Profile(
-            public_key=public_key,
-            name=name,
-            nip05=nip05,
-            pic=pic,
-            about=about,
-            updated_at=updated_at,
-            raw=raw
-        ))
-        self.session.commit()
-
-    def set_valid_nip05(self, public_key):
-        self.session.query(Profile).filter(Profile.public_key == public_key).update({'nip05_validated': True})
-
-    def update_note_media(self, note_id, media):
-        self.session.query(Note).filter(Note.id == note_id).update({'media': media})
-        self.session.commit()
+                    raw=None,
+                    nip05_validated=False):
+        row = {
+            'public_key': public_key,
+            'name': name,
+            'nip05': nip05,
+            'pic': pic,
+            'about': about,
+            'updated_at': updated_at,
+            'raw': raw,
+            'nip05_validated': nip05_validated
+        }
+        if self.in_batch():
+            self.batch_state.profiles[public_key] = row
+            self.profile_changed(public_key)
+        else:
+            self.apply_profile_updates([row])
+            self.commit_or_flush()
+            self.profile_changed(public_key)
+            self.remember_profile_versions([row])
+
+    # write metadata rows in a single upsert, a row never replaces newer metadata
+    def apply_profile_updates(self, rows: list):
+        if len(rows) == 0:
+            return
+        self.session.flush()
+        stmt = sqlite_insert(Profile)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Profile.public_key],
+            set_={k: stmt.excluded[k] for k in ['name', 'nip05', 'pic', 'about', 'updated_at', 'raw', 'nip05_validated']},
+            where=or_(Profile.updated_at.is_(None), Profile.updated_at < stmt.excluded.updated_at)
+        )
+        self.session.execute(stmt, rows)
+
+    @staticmethod
+    def remember_profile_versions(rows):
+        PROFILE_VERSIONS.put({
+            r['public_key']: ProfileVersion(r['updated_at'], r['nip05'], r['nip05_validated']) for r in rows
+        })
+
+    # the metadata currently stored for a pubkey, including updates still waiting in the batch
+    def get_profile_version(self, public_key):
+        if self.in_batch() and public_key in self.batch_state.profiles:
+            row = self.batch_state.profiles[public_key]
+            return ProfileVersion(row['updated_at'], row['nip05'], row['nip05_validated'])
+        version = PROFILE_VERSIONS.get(public_key)
+        if version is None:
+            self.load_profile_versions([public_key])
+            version = PROFILE_VERSIONS.get(public_key) or NO_PROFILE
+        return version
+
+    # load the stored metadata versions of any keys not already in memory
+    def load_profile_versions(self, public_keys):
+        missing = PROFILE_VERSIONS.missing(public_keys)
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            versions = dict.fromkeys(chunk, NO_PROFILE)
+            rows = self.session.query(
+                Profile.public_key,
+                Profile.updated_at,
+                Profile.nip05,
+                Profile.nip05_validated).filter(Profile.public_key.in_(chunk)).all()
+            for r in rows:
+                versions[r.public_key] = ProfileVersion(r.updated_at, r.nip05, bool(r.nip05_validated))
+            PROFILE_VERSIONS.put(versions)
+
+    # with nip05 given the flag is only set while the profile still claims that identifier,
+    # a late verification result can't mark a newer one
+    def set_valid_nip05(self, public_key, nip05=None, valid=True):
+        q = self.session.query(Profile).filter(Profile.public_key == public_key)
+        if nip05 is not None:
+            q = q.filter(Profile.nip05 == nip05)
+        if q.update({'nip05_validated': valid}, synchronize_session=False) > 0:
+            self.profile_changed(public_key)
+
+    def get_og_cache(self, url):
+        return self.session.query(OGCache).filter(OGCache.url == url).first()
+
+    # results are (url, og dict or None, http status, note ids) from the link preview workers
+    def store_og_results(self, results):
+        now = int(time.time())
+        stmt = sqlite_insert(OGCache)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[OGCache.url],
+            set_={
+                'title': stmt.excluded.title,
+                'description': stmt.excluded.description,
+                'image': stmt.excluded.image,
+                'og_url': stmt.excluded.og_url,
+                'status': stmt.excluded.status,
+                'fetched_at': stmt.excluded.fetched_at,
+                'attempts': case(
+                    (stmt.excluded.og_url.is_(None), func.coalesce(OGCache.attempts, 0) + 1),
+                    else_=0)
+            }
+        )
+        rows = []
+        media = []
+        for url, og, status, note_ids in results:
+            og = og or {}
+            rows.append({
+                'url': url,
+                'title': og.get('title'),
+                'description': og.get('description'),
+                'image': og.get('image'),
+                'og_url': og.get('url'),
+                'status': status,
+                'fetched_at': now,
+                'attempts': 0 if len(og) > 0 else 1
+            })
+            if len(og) > 0:
+                media += [(note_id, [og, 'og']) for note_id in note_ids]
+        self.session.execute(stmt, rows)
+        if len(media) > 0:
+            self.add_note_media(media)
+        else:
+            self.commit_or_flush()
+
+    # items are (note_id, media item) pairs appended to each note's media list
+    def add_note_media(self, items):
+        notes = {n.id: n for n in self.session.query(Note).filter(Note.id.in_({i[0] for i in items}))}
+        for note_id, item in items:
+            note = notes.get(note_id)
+            if note is not None:
+                media = json.loads(note.media) if note.media else []
+                media.append(item)
+                note.media = json.dumps(media)
+        self.commit_or_flush()
+        for note_id in notes:
+            self.note_changed(note_id)
 
     def insert_note(self,
                     note_id,
@@ -177,7 +533,20 @@ class BijaDB:
                 media=media,
                 raw=raw
             ))
-            self.session.commit()
+            self.commit_or_flush()
+
+    # a note I composed goes into the timeline in the same write, it may never be echoed back by a relay
+    def insert_own_note(self,
+                        note_id,
+                        public_key,
+                        content,
+                        response_to=None,
+                        thread_root=None,
+                        reshare=None,
+                        created_at=None,
+                        members=None):
+        self.insert_note(note_id, public_key, content, response_to, thread_root, reshare, created_at, members)
+        self.add_to_timeline(note_id, public_key, created_at, public_key)
 
     def is_note(self, note_id):
         return self.session.query(Note.id).filter_by(id=note_id).first()
@@ -187,30 +556,10 @@ class BijaDB:
 
     def add_profile_if_not_exists(self, pk):
         self.session.merge(Profile(public_key=pk))
-        self.session.commit()
+        self.commit_or_flush()
 
     def get_note(self, note_id):
-
-        return self.session.query(Note.id,
-                                  Note.public_key,
-                                  Note.content,
-                                  Note.response_to,
-                                  Note.thread_root,
-                                  Note.reshare,
-                                  Note.created_at,
-                                  Note.members,
-                                  Note.media,
-                                  ReactionTally.likes,
-                                  ReactionTally.replies,
-                                  ReactionTally.shares,
-                                  Note.liked,
-                                  Note.shared,
-                                  Note.deleted,
-                                  Profile.name,
-                                  Profile.pic,
-                                  Profile.nip05,
-                                  Profile.nip05_validated,
-                                  Profile.following).filter_by(id=note_id) \
+        return self.session.query(*NOTE_COLUMNS).filter(Note.id == note_id) \
             .outerjoin(ReactionTally, ReactionTally.event_id == Note.id) \
             .join(Note.profile).first()
 
@@ -218,51 +567,22 @@ class BijaDB:
         return self.session.query(Note.raw).filter_by(id=note_id).first()
 
     def get_note_thread(self, note_id):
-
-        items = self.session.query(Note.id, Note.response_to) \
-            .filter(
-            text("note.id='{}' or note.response_to='{}' or note.thread_root='{}'".format(note_id, note_id, note_id))) \
-            .join(Note.profile).all()
-
-        return self.session.query(Note.id,
-                                  Note.public_key,
-                                  Note.content,
-                                  Note.response_to,
-                                  Note.thread_root,
-                                  Note.reshare,
-                                  Note.created_at,
-                                  Note.members,
-                                  Note.media,
-                                  Note.liked,
-                                  Note.shared,
-                                  Note.deleted,
-                                  ReactionTally.likes,
-                                  ReactionTally.replies,
-                                  ReactionTally.shares,
-                                  Profile.name,
-                                  Profile.pic,
-                                  Profile.nip05,
-                                  Profile.nip05_validated,
-                                  Profile.following) \
-            .filter(or_(Note.id.in_([i.response_to for i in items]), Note.id.in_([i.id for i in items]))) \
+        ids = thread_ids(note_id).subquery()
+        return self.session.query(*NOTE_COLUMNS) \
+            .filter(Note.id.in_(select(ids.c.id))) \
             .outerjoin(ReactionTally, ReactionTally.event_id == Note.id) \
             .join(Note.profile).order_by(Note.created_at.asc()).all()
 
+    # includes referenced ids that are not stored yet so they can be requested from relays
     def get_note_thread_ids(self, note_id):
+        ids = thread_ids(note_id).subquery()
         items = self.session.query(Note.id, Note.response_to, Note.thread_root, Note.reshare) \
-            .filter(
-            text("note.id='{}' or note.response_to='{}' or note.thread_root='{}'".format(note_id, note_id, note_id))) \
-            .all()
-
-        l1 = [i.id for i in items]
-        l2 = [i.response_to for i in items]
-        l3 = [i.thread_root for i in items]
-        l4 = [i.reshare for i in items]
+            .filter(Note.id.in_(select(ids.c.id))).all()
 
-        out = list(dict.fromkeys(l1 + l2 + l3 + l4))
-        if None in out:
-            out.remove(None)
-            return out
+        out = [note_id]
+        for i in items:
+            out += [i.id, i.response_to, i.thread_root, i.reshare]
+        return [i for i in dict.fromkeys(out) if i is not None]
 
     def insert_private_message(self,
                                msg_id,
@@ -279,37 +599,27 @@ class BijaDB:
             created_at=created_at,
             raw=raw
         ))
-        self.session.commit()
+        self.commit_or_flush()
 
-    def get_feed(self, before, public_key):
-
-        return self.session.query(
-            Note.id,
-            Note.public_key,
-            Note.content,
-            Note.response_to,
-            Note.thread_root,
-            Note.reshare,
-            Note.created_at,
-            Note.members,
-            Note.media,
-            Note.liked,
-            Note.shared,
-            Note.deleted,
-            ReactionTally.likes,
-            ReactionTally.replies,
-            ReactionTally.shares,
-            Profile.name,
-            Profile.pic,
-            Profile.nip05,
-            Profile.nip05_validated,
-            Profile.following) \
+    # pages are keyed on (created_at, id) so that notes sharing a timestamp are neither skipped nor repeated
+    def get_feed(self, before, before_id=None):
+        return self.session.query(*NOTE_COLUMNS) \
+            .select_from(Timeline) \
+            .join(Note, Note.id == Timeline.note_id) \
             .outerjoin(ReactionTally, ReactionTally.event_id == Note.id) \
             .join(Note.profile) \
-            .filter(text("note.created_at<{}".format(before))) \
-            .filter(text("(profile.following=1 OR profile.public_key='{}')".format(public_key))) \
-            .filter(text("note.deleted is not 1")) \
-            .order_by(Note.seen.desc()).order_by(Note.created_at.desc()).limit(50).all()
+            .filter(keyset_before(before, before_id, Timeline.created_at, Timeline.note_id)) \
+            .filter(Note.deleted.isnot(1)) \
+            .order_by(Timeline.created_at.desc(), Timeline.note_id.desc()).limit(50).all()
+
+    # full rows for a list of note ids, used to resolve thread roots and reshares for a page in one query
+    def get_notes(self, note_ids):
+        if len(note_ids) == 0:
+            return []
+        return self.session.query(*NOTE_COLUMNS) \
+            .outerjoin(ReactionTally, ReactionTally.event_id == Note.id) \
+            .join(Note.profile) \
+            .filter(Note.id.in_(note_ids)).all()
 
     def get_note_by_id_list(self, note_ids):
         return self.session.query(
@@ -323,35 +633,14 @@ class BijaDB:
             Profile.pic,
             Profile.nip05).join(Note.profile).filter(Note.id.in_(note_ids)).all()
 
-    def get_notes_by_pubkey(self, public_key, before, after):
-
-        return self.session.query(
-            Note.id,
-            Note.public_key,
-            Note.content,
-            Note.response_to,
-            Note.thread_root,
-            Note.reshare,
-            Note.created_at,
-            Note.members,
-            Note.media,
-            Note.liked,
-            Note.shared,
-            ReactionTally.likes,
-            ReactionTally.replies,
-            ReactionTally.shares,
-            Note.deleted,
-            Profile.name,
-            Profile.pic,
-            Profile.nip05,
-            Profile.nip05_validated,
-            Profile.following) \
+    def get_notes_by_pubkey(self, public_key, before, after, before_id=None):
+        return self.session.query(*NOTE_COLUMNS) \
             .outerjoin(ReactionTally, ReactionTally.event_id == Note.id) \
             .join(Note.profile) \
-            .filter(text("note.created_at<{}".format(before))) \
-            .filter_by(public_key=public_key) \
-            .filter(text("note.deleted is not 1")) \
-            .order_by(Note.created_at.desc()).limit(100).all()
+            .filter(keyset_before(before, before_id)) \
+            .filter(Note.public_key == public_key) \
+            .filter(Note.deleted.isnot(1)) \
+            .order_by(Note.created_at.desc(), Note.id.desc()).limit(100).all()
 
     def get_unseen_message_count(self):
         return self.session.query(PrivateMessage) \
@@ -375,9 +664,12 @@ class BijaDB:
             out.append(dict(item))
         return out
 
-    def get_unseen_in_feed(self):
-        return self.session.query(Note, Profile).join(Note.profile) \
-            .filter(text("(profile.following=1) and note.seen=0")).count()
+    # unseen notes in the home timeline, my own posts don't count
+    def get_unseen_in_feed(self, my_public_key):
+        return self.session.query(func.count(Timeline.note_id)) \
+            .join(Note, Note.id == Timeline.note_id) \
+            .filter(Note.seen == 0) \
+            .filter(Timeline.public_key != my_public_key).scalar()
 
     def get_most_recent_for_pk(self, pubkey):
         q = self.session.query(Note.created_at).join(Note.profile) \
@@ -386,16 +678,15 @@ class BijaDB:
             return q['created_at']
         return None
 
-    def set_all_seen_in_feed(self, public_key):
-        notes = self.session.query(Note).join(Note.profile) \
-            .filter(text("profile.following=1 OR profile.public_key='{}'".format(public_key)))
-        for note in notes:
-            note.seen = True
-        self.session.commit()
+    def set_all_seen_in_feed(self):
+        self.session.query(Note).filter(Note.seen == 0) \
+            .filter(Note.id.in_(self.session.query(Timeline.note_id))) \
+            .update({'seen': True}, synchronize_session=False)
+        self.commit_or_flush()
 
     def set_note_seen(self, note_id):
         self.session.query(Note).filter(Note.id == note_id).update({'seen': True})
-        self.session.commit()
+        self.commit_or_flush()
 
     # def get_profile_updates(self, public_key, last_update):
     #     return self.session.query(Profile).filter_by(public_key=public_key).filter(
@@ -418,7 +709,7 @@ class BijaDB:
         ).order_by(Profile.following.desc()).first()
 
     def get_message_list(self):
-        return DB_ENGINE.execute(text("""SELECT 
+        return self.session.execute(text("""SELECT 
                 max(PM2.created_at) AS last_message, 
                 profile.public_key AS public_key, 
                 profile.name AS name, 
@@ -429,7 +720,6 @@ class BijaDB:
                 ORDER BY PM2.created_at DESC"""))
 
     def get_message_thread(self, public_key):
-        self.set_message_thread_read(public_key)
         filter_text = "profile.public_key = private_message.public_key AND private_message.public_key='{}'"
         return self.session.query(
             PrivateMessage.is_sender,
@@ -443,7 +733,7 @@ class BijaDB:
 
     def set_message_thread_read(self, public_key):
         self.session.query(PrivateMessage).filter(PrivateMessage.public_key == public_key).update({'seen': True})
-        self.session.commit()
+        self.commit_or_flush()
 
     def add_note_reaction(self, eid, public_key, event_id, event_pk, content, members, raw):
         self.session.merge(NoteReaction(
@@ -455,19 +745,19 @@ class BijaDB:
             members=members,
             raw=raw
         ))
-        self.session.commit()
+        self.commit_or_flush()
 
     def delete_reaction(self, reaction_id):
         self.session.query(Event).filter_by(id=reaction_id).delete()
         self.session.query(NoteReaction).filter_by(id=reaction_id).delete()
-        self.session.commit()
+        self.commit_or_flush()
 
     def set_note_liked(self, note_id, liked=True):
         self.session.merge(Note(
             id=note_id,
             liked=liked
         ))
-        self.session.commit()
+        self.commit_or_flush()
 
     def get_note_reactions(self, note_id):
         stmt = (
@@ -493,7 +783,8 @@ class BijaDB:
             content=reason,
             deleted=1
         ))
-        self.session.commit()
+        self.commit_or_flush()
+        self.note_changed(note_id)
 
     def get_like_count(self, note_id):
         return self.session.query(NoteReaction.event_id).filter(NoteReaction.event_id == note_id).filter(
@@ -508,11 +799,16 @@ class BijaDB:
             id=event_id,
             kind=kind
         ))
-        self.session.commit()
+        self.commit_or_flush()
 
     def get_event(self, event_id):
         return self.session.query(Event.id, Event.kind).filter(Event.id == event_id).first()
 
+    # ids of the most recently stored events, oldest first
+    def get_recent_event_ids(self, limit):
+        ids = self.session.query(Event.id).order_by(text("rowid DESC")).limit(limit).all()
+        return [i.id for i in reversed(ids)]
+
     def add_alert(self, event_id, kind, profile, event, ts, content):
         self.session.merge(Alert(
             id=event_id,
@@ -522,7 +818,7 @@ class BijaDB:
             ts=ts,
             content=content
         ))
-        self.session.commit()
+        self.commit_or_flush()
 
     def get_alerts(self):
         return self.session.query(
@@ -549,40 +845,45 @@ class BijaDB:
 
     def set_alerts_read(self):
         self.session.query(Alert).filter(Alert.seen == 0).update({'seen': True})
-        self.session.commit()
+        self.commit_or_flush()
 
     def increment_note_reply_count(self, event_id):
-        replies = 1
-        tally = self.session.query(ReactionTally.replies).filter(ReactionTally.event_id == event_id).first()
-        if tally is not None:
-            replies = tally.replies + 1
-        self.session.merge(ReactionTally(
-            event_id=event_id,
-            replies=replies
-        ))
-        self.session.commit()
+        self.increment_note_tally(event_id, replies=1)
 
     def increment_note_share_count(self, event_id):
-        shares = 1
-        tally = self.session.query(ReactionTally.shares).filter(ReactionTally.event_id == event_id).first()
-        if tally is not None:
-            shares = tally.shares + 1
-        self.session.merge(ReactionTally(
-            event_id=event_id,
-            shares=shares
-        ))
-        self.session.commit()
+        self.increment_note_tally(event_id, shares=1)
 
     def increment_note_like_count(self, event_id):
-        likes = 1
-        tally = self.session.query(ReactionTally.likes).filter(ReactionTally.event_id == event_id).first()
-        if tally is not None:
-            likes = tally.likes + 1
-        self.session.merge(ReactionTally(
-            event_id=event_id,
-            likes=likes
-        ))
-        self.session.commit()
+        self.increment_note_tally(event_id, likes=1)
+
+    # while a batch is open the deltas are collected and applied together when it's committed
+    def increment_note_tally(self, event_id, likes=0, shares=0, replies=0):
+        if self.in_batch():
+            tally = self.batch_state.tallies.setdefault(event_id, {'likes': 0, 'shares': 0, 'replies': 0})
+            tally['likes'] += likes
+            tally['shares'] += shares
+            tally['replies'] += replies
+        else:
+            self.apply_tally_deltas({event_id: {'likes': likes, 'shares': shares, 'replies': replies}})
+            self.commit_or_flush()
+
+    # add the deltas to the reaction tallies in a single upsert, deltas = {event_id: {likes, shares, replies}}
+    def apply_tally_deltas(self, deltas: dict):
+        if len(deltas) == 0:
+            return
+        stmt = sqlite_insert(ReactionTally)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ReactionTally.event_id],
+            set_={
+                'likes': func.coalesce(ReactionTally.likes, 0) + stmt.excluded.likes,
+                'shares': func.coalesce(ReactionTally.shares, 0) + stmt.excluded.shares,
+                'replies': func.coalesce(ReactionTally.replies, 0) + stmt.excluded.replies
+            }
+        )
+        self.session.execute(stmt, [
+            {'event_id': event_id, 'likes': d['likes'], 'shares': d['shares'], 'replies': d['replies']}
+            for event_id, d in deltas.items()
+        ])
 
     def get_settings_by_keys(self, keys: list):
         return self.session.query(Settings.key, Settings.value).filter(Settings.key.in_(keys)).all()
@@ -600,7 +901,7 @@ class BijaDB:
                 key=setting[0],
                 value=setting[1],
             ))
-        self.session.commit()
+        self.commit_or_flush()
 
     def commit(self):
         self.session.commit()
@@ -0,0 +1,111 @@
+import logging
+import traceback
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread
+
+from bija.app import app
+from bija.args import LOGGING_LEVEL
+from bija.config import WRITER_BATCH_SIZE
+from bija.db import BijaDB
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGGING_LEVEL)
+
+
+class WriteJob:
+    def __init__(self, task, args, kwargs, exclusive):
+        self.task = task
+        self.args = args
+        self.kwargs = kwargs
+        self.exclusive = exclusive
+        self.future = Future()
+
+
+# Owns all database mutations. Jobs are queued from any thread and executed in order on a single
+# writer thread, jobs that are waiting together are applied in one transaction.
+# A task is either the name of a BijaDB method or a callable, exclusive jobs run on their own and
+# manage their own transaction (eg. an ingest batch).
+class DBWriter:
+
+    def __init__(self):
+        logger.info('DB WRITER')
+        self.jobs: Queue[WriteJob] = Queue()
+        self.db = BijaDB(app.session)
+        self.thread = Thread(target=self.run, daemon=True, name='db-writer')
+        self.thread.start()
+        self.submit(self.backfill)
+
+    def submit(self, task, *args, exclusive=False, **kwargs) -> Future:
+        job = WriteJob(task, args, kwargs, exclusive)
+        self.jobs.put(job)
+        return job.future
+
+    # submit and wait for the result
+    def call(self, task, *args, **kwargs):
+        return self.submit(task, *args, **kwargs).result()
+
+    def run(self):
+        held = None
+        while True:
+            job = held if held is not None else self.jobs.get()
+            held = None
+            if job.exclusive:
+                self.execute_exclusive(job)
+                continue
+            group = [job]
+            while len(group) < WRITER_BATCH_SIZE:
+                try:
+                    job = self.jobs.get_nowait()
+                except Empty:
+                    break
+                if job.exclusive:
+                    held = job
+                    break
+                group.append(job)
+            self.execute(group)
+
+    # jobs run inside an app context (templates are rendered for UI signals), which also
+    # removes the thread's sessions when it is torn down
+    def execute(self, group):
+        with app.app_context():
+            results = []
+            try:
+                with self.db.batch():
+                    for job in group:
+                        results.append(self.run_task(job))
+            except Exception as e:
+                if len(group) > 1:
+                    # retry one at a time so that a single failing job doesn't fail the others
+                    for job in group:
+                        self.execute([job])
+                else:
+                    logging.error(traceback.format_exc())
+                    group[0].future.set_exception(e)
+                return
+        for job, result in zip(group, results):
+            job.future.set_result(result)
+
+    def execute_exclusive(self, job):
+        with app.app_context():
+            try:
+                result = self.run_task(job)
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                self.db.session.rollback()
+                job.future.set_exception(e)
+                return
+        job.future.set_result(result)
+
+    # migration backfills run as writer jobs, one chunk at a time and queued behind whatever else is waiting
+    def backfill(self):
+        if self.db.run_backfill_step():
+            self.submit(self.backfill)
+
+    def run_task(self, job):
+        if isinstance(job.task, str):
+            return getattr(self.db, job.task)(*job.args, **job.kwargs)
+        return job.task(*job.args, **job.kwargs)
+
+
+DB_WRITER = DBWriter()
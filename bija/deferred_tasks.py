@@ -1,22 +1,24 @@
-import json
+import codecs
 import logging
-import urllib
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
+from html.parser import HTMLParser
 from queue import Queue
 from threading import Lock
-from urllib import request
-from urllib.error import HTTPError, URLError
-from socket import timeout
-from urllib.request import Request
 
+import requests
 import validators
-from bs4 import BeautifulSoup
 
 from bija.app import app
 from bija.args import LOGGING_LEVEL
-from bija.db import BijaDB
+from bija.config import OG_FETCH_WORKERS, OG_FETCH_RATE, OG_FETCH_MAX_PENDING, \
+    OG_WRITE_BATCH_SIZE, OG_WRITE_INTERVAL, OG_MAX_BYTES, OG_READ_CHUNK, OG_READ_DEADLINE, OG_CONTENT_TYPES
+from bija.db_writer import DB_WRITER
+from bija.http_client import HTTP_CLIENT
+from bija.helpers import normalize_url
 
-DB = BijaDB(app.session)
 logger = logging.getLogger(__name__)
 logger.setLevel(LOGGING_LEVEL)
 
@@ -50,18 +52,129 @@ class TaskPool:
         return self.tasks.qsize() > 0
 
 
+# spaces requests at least 1/rate seconds apart across all workers
+class RateLimit:
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = 0
+        self.lock = Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Tasks are queued by event handlers and handed to a small worker pool on each tick of the event loop,
+# so slow sites never block ingestion. Each url is fetched once however many notes link to it,
+# results are written to the og cache and attached to the waiting notes in batches.
 class DeferredTasks:
 
     def __init__(self) -> None:
         logger.info('DEFERRED TASKS')
         self.pool = TaskPool()
+        self.executor = ThreadPoolExecutor(max_workers=OG_FETCH_WORKERS, thread_name_prefix='og-fetch')
+        self.rate_limit = RateLimit(OG_FETCH_RATE)
+        self.in_flight = 0
+        # normalized url -> OGFetch, kept until its result has been handed to the db writer
+        self.fetches = {}
+        self.lock = Lock()
+        self.last_flush = time.monotonic()
 
     def next(self) -> None:
-        if self.pool.has_tasks():
+        while self.pool.has_tasks() and self.in_flight < OG_FETCH_MAX_PENDING:
             logger.info('NEXT task')
             task = self.pool.get()
             if task.kind == TaskKind.FETCH_OG:
-                OGTags(task.data)
+                self.fetch_og(task.data)
+        self.flush_results()
+
+    def fetch_og(self, data):
+        url = normalize_url(data['url'])
+        with self.lock:
+            fetch = self.fetches.get(url)
+            if fetch is not None:
+                fetch.note_ids.append(data['note_id'])
+                return
+            fetch = OGFetch(url, data['url'], data['note_id'])
+            self.fetches[url] = fetch
+            self.in_flight += 1
+        self.executor.submit(self.run_fetch, fetch)
+
+    def run_fetch(self, fetch):
+        try:
+            self.rate_limit.wait()
+            tags = OGTags({'url': fetch.source_url, 'note_id': fetch.note_ids[0]})
+            fetch.og = tags.og
+            fetch.status = tags.status
+        except Exception:
+            logging.error(traceback.format_exc())
+        finally:
+            with self.lock:
+                fetch.done = True
+                self.in_flight -= 1
+
+    def flush_results(self):
+        with self.lock:
+            done = [f for f in self.fetches.values() if f.done]
+            if len(done) == 0:
+                return
+            due = time.monotonic() - self.last_flush >= OG_WRITE_INTERVAL
+            if not due and len(done) < OG_WRITE_BATCH_SIZE:
+                return
+            for f in done:
+                del self.fetches[f.url]
+            results = [(f.url, f.og, f.status, list(f.note_ids)) for f in done]
+            self.last_flush = time.monotonic()
+        logger.info('store {} OG results'.format(len(results)))
+        DB_WRITER.submit('store_og_results', results)
+
+
+# the og dict stored in note media, built from an og_cache row
+def og_cache_data(row):
+    og = {'image': row.image, 'title': row.title, 'description': row.description, 'url': row.og_url}
+    return {k: v for k, v in og.items() if v is not None}
+
+
+class OGFetch:
+
+    def __init__(self, url, source_url, note_id):
+        self.url = url
+        self.source_url = source_url
+        self.note_ids = [note_id]
+        self.og = {}
+        self.status = 0
+        self.done = False
+
+
+# Collects <meta property="og:*"> tags as the page streams in and flags when the head is over.
+# Like BeautifulSoup's find(), the first meta tag for a property wins even if it has no content.
+class OGMetaParser(HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.meta = {}
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            attrs = dict(attrs)
+            prop = attrs.get('property')
+            if prop is not None and prop.startswith('og:') and prop not in self.meta:
+                self.meta[prop] = attrs.get('content')
+        elif tag == 'body':
+            self.done = True
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.done = True
 
 
 class OGTags:
@@ -71,52 +184,57 @@ class OGTags:
         self.note_id = data['note_id']
         self.url = data['url']
         self.og = {}
-        self.note = DB.get_note(self.note_id)
+        self.status = 0
 
-        response = self.fetch()
-        if response:
-            self.process(response)
+        meta = self.fetch()
+        if meta:
+            self.process(meta)
 
+    # streams the page until the end of <head>, OG_MAX_BYTES or OG_READ_DEADLINE, whichever comes first
+    # pages sent without a Content-Type are read too, they may still be html
     def fetch(self):
         logger.info('fetch for {}'.format(self.url))
-        req = Request(self.url, headers={'User-Agent': 'Bija Nostr Client'})
         try:
-            with urllib.request.urlopen(req, timeout=2) as response:
-                if response.status == 200:
-                    return response.read()
-                return False
-        except HTTPError as error:
-            print(error.status, error.reason)
-            return False
-        except URLError as error:
-            print(error.reason)
-            return False
-        except TimeoutError:
+            with HTTP_CLIENT.stream(self.url, deadline=OG_READ_DEADLINE) as response:
+                self.status = response.status_code
+                if response.status_code != 200:
+                    print(response.status_code, response.reason)
+                    return False
+                content_type, charset = HTTP_CLIENT.content_type(response)
+                if content_type is not None and content_type not in OG_CONTENT_TYPES:
+                    logger.info('skip {} ({})'.format(self.url, content_type))
+                    return False
+                try:
+                    decoder = codecs.getincrementaldecoder(charset or 'utf-8')(errors='replace')
+                except LookupError:
+                    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+                parser = OGMetaParser()
+                received = 0
+                for chunk in HTTP_CLIENT.iter_body(response, OG_MAX_BYTES, OG_READ_CHUNK):
+                    received += len(chunk)
+                    parser.feed(decoder.decode(chunk))
+                    if parser.done:
+                        break
+                logger.info('read {} bytes of {}'.format(received, self.url))
+                return parser.meta
+        except requests.Timeout:
             print("Request timed out")
             return False
+        except requests.RequestException as error:
+            print(error)
+            return False
 
-    def process(self, response):
+    def process(self, meta):
         logger.info('process {}'.format(self.url))
-        if response is not None:
-            soup = BeautifulSoup(response, 'html.parser')
-            for prop in ['image', 'title', 'description', 'url']:
-                item = soup.find("meta", property="og:{}".format(prop))
-                if item is not None:
-                    content = item.get("content")
-                    if content is not None:
-                        if prop in ['url', 'image']:
-                            if validators.url(content):
-                                self.og[prop] = content
-                        else:
-                            self.og[prop] = content
-
-            if len(self.og) > 0:
-                if 'url' not in self.og:
-                    self.og['url'] = self.url
-                self.store()
-
-    def store(self):
-        logger.info('store OG')
-        media = json.loads(self.note['media'])
-        media.append([self.og, 'og'])
-        DB.update_note_media(self.note_id, json.dumps(media))
+        for prop in ['image', 'title', 'description', 'url']:
+            content = meta.get("og:{}".format(prop))
+            if content is not None:
+                if prop in ['url', 'image']:
+                    if validators.url(content):
+                        self.og[prop] = content
+                else:
+                    self.og[prop] = content
+
+        if len(self.og) > 0:
+            if 'url' not in self.og:
+                self.og['url'] = self.url
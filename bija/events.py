@@ -3,6 +3,9 @@ import os
 import ssl
 import textwrap
 import time
+import traceback
+from queue import Empty
+from threading import Thread, Event as ThreadEvent
 from urllib.parse import urlparse
 
 import validators as validators
@@ -10,9 +13,17 @@ from flask import render_template
 
 from bija.app import socketio
 from bija.args import LOGGING_LEVEL
-from bija.deferred_tasks import TaskKind, DeferredTasks
-from bija.helpers import get_embeded_tag_indexes, \
-    list_index_exists, get_urls_in_string, request_nip05, url_linkify, strip_tags, request_relay_data, is_nip05
+from bija.config import INGEST_BATCH_SIZE, INGEST_FLUSH_MS, SEEN_EVENTS_SIZE, VERIFY_WORKERS, \
+    OG_CACHE_TTL, OG_NEGATIVE_TTL, OG_MAX_ATTEMPTS
+from bija.db_writer import DB_WRITER
+from bija.deferred_tasks import TaskKind, DeferredTasks, og_cache_data
+from bija.http_client import HTTP_CLIENT
+from bija.nip05 import NIP05_VERIFIER
+from bija.profile_versions import PROFILE_VERSIONS
+from bija.seen_events import SeenEvents
+from bija.verification import EventVerifier
+from bija.helpers import tokenize_content, replace_tokens, url_link, normalize_url, \
+    list_index_exists, strip_tags, request_relay_data, is_nip05
 from bija.subscriptions import *
 from bija.submissions import *
 from bija.alerts import *
@@ -27,6 +38,15 @@ logging.basicConfig(format=FORMAT)
 logger.setLevel(LOGGING_LEVEL)
 
 D_TASKS = DeferredTasks()
+SEEN_EVENTS = SeenEvents(SEEN_EVENTS_SIZE)
+VERIFIER = EventVerifier(VERIFY_WORKERS)
+
+# UI signals where only the most recent value is of interest
+COALESCED_SIGNALS = {'unseen_posts_n', 'unseen_messages_n', 'alert_n', 'new_profile_posts'}
+
+IDLE_TIMEOUT = 1  # seconds the event loop waits for new events before attending to other tasks
+HEARTBEAT_INTERVAL = 60
+
 DB = BijaDB(app.session)
 
 
@@ -41,7 +61,12 @@ class BijaEvents:
 
     def __init__(self):
         self.should_run = True
+        self.stopped = ThreadEvent()
+        self.pending_signals = {}
+        self.unseen_posts_changed = False
+        self.pending_batch = None
         self.relay_manager = RelayManager()
+        SEEN_EVENTS.warm(DB.get_recent_event_ids(SEEN_EVENTS_SIZE))
         self.open_connections()
 
     def open_connections(self):
@@ -100,7 +125,7 @@ class BijaEvents:
         if self.pool_handler_running:
             return
         self.pool_handler_running = True
-        i = 0
+        Thread(target=self.heartbeat, daemon=True).start()
         while self.should_run:
             while self.relay_manager.message_pool.has_notices():
                 notice = self.relay_manager.message_pool.get_notice()
@@ -111,39 +136,140 @@ class BijaEvents:
             while self.relay_manager.message_pool.has_eose_notices():
                 notice = self.relay_manager.message_pool.get_eose_notice()
 
-            while self.relay_manager.message_pool.has_events():
-                msg = self.relay_manager.message_pool.get_event()
-                if DB.get_event(msg.event.id) is None:
-                    logger.info('New event: {}'.format(msg.event.kind))
-                    if msg.event.kind == EventKind.SET_METADATA:
-                        self.receive_metadata_event(msg.event)
+            batch = self.prepare_events(self.collect_events())
+            if len(batch) > 0:
+                self.store_events(batch)
+            D_TASKS.next()
 
-                    if msg.event.kind == EventKind.CONTACTS:
-                        self.receive_contact_list_event(msg.event, msg.subscription_id)
+    # periodically refresh relay status and subscriptions in the UI
+    def heartbeat(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            logger.info('Heartbeat {}'.format(int(time.time())))
+            logger.info('Seen events filter {}'.format(SEEN_EVENTS.stats()))
+            logger.info('Event verification {}'.format(VERIFIER.stats()))
+            logger.info('Outbound http {}'.format(HTTP_CLIENT.stats()))
+            logger.info('Profile versions {}'.format(PROFILE_VERSIONS.stats()))
+            self.get_connection_status()
+            socketio.emit('subscriptions', list(self.subscriptions))
+
+    # block until an event arrives (or the idle timeout passes), then take whatever else is already
+    # waiting in the pool until the batch is full or the flush interval has passed
+    def collect_events(self):
+        batch = []
+        msg = self.next_event(IDLE_TIMEOUT)
+        if msg is None:
+            return batch
+        batch.append(msg)
+        batch_size = Settings.get_int('ingest_batch_size', INGEST_BATCH_SIZE)
+        flush_at = time.time() + Settings.get_int('ingest_flush_ms', INGEST_FLUSH_MS) / 1000
+        while len(batch) < batch_size and time.time() < flush_at:
+            msg = self.next_event()
+            if msg is None:
+                break
+            batch.append(msg)
+        return batch
+
+    def next_event(self, timeout=None):
+        try:
+            if timeout is None:
+                return self.relay_manager.message_pool.events.get_nowait()
+            return self.relay_manager.message_pool.events.get(timeout=timeout)
+        except Empty:
+            return None
+
+    # drop events that were already processed, repeated within the batch or carry outdated profile metadata,
+    # then verify the remainder
+    @staticmethod
+    def prepare_events(batch):
+        fresh = {}
+        for msg in batch:
+            if msg.event.kind == EventKind.SET_METADATA and \
+                    PROFILE_VERSIONS.is_stale(msg.event.public_key, msg.event.created_at):
+                continue
+            if msg.event.id not in fresh and not SEEN_EVENTS.seen(msg.event.id):
+                fresh[msg.event.id] = msg
+        if len(fresh) == 0:
+            return []
+        return VERIFIER.verify(list(fresh.values()))
+
+    # hand the batch to the db writer, the next batch is collected and verified while this one is stored
+    # but only one batch is queued at a time
+    def store_events(self, batch):
+        if self.pending_batch is not None:
+            self.pending_batch.exception()
+        self.pending_batch = DB_WRITER.submit(self.process_events, batch, exclusive=True)
+
+    # store a batch of events in a single transaction, UI signals are sent once it is committed
+    def process_events(self, batch):
+        logger.info('Process batch of {} events'.format(len(batch)))
+        try:
+            with DB.batch():
+                DB.load_profile_versions(
+                    [msg.event.public_key for msg in batch if msg.event.kind == EventKind.SET_METADATA])
+                for msg in batch:
+                    self.receive_event(msg)
+        except Exception:
+            logging.error(traceback.format_exc())
+            for msg in batch:
+                SEEN_EVENTS.discard(msg.event.id)
+            self.pending_signals = {}
+            self.unseen_posts_changed = False
+            if len(batch) > 1:
+                # retry one at a time so that a single bad event doesn't drop the whole batch
+                for msg in batch:
+                    self.process_events([msg])
+            return
+        self.send_pending_signals()
 
-                    if msg.event.kind == EventKind.TEXT_NOTE:
-                        self.receive_note_event(msg.event, msg.subscription_id)
+    def receive_event(self, msg):
+        if DB.get_event(msg.event.id) is None:
+            logger.info('New event: {}'.format(msg.event.kind))
+            if msg.event.kind == EventKind.SET_METADATA:
+                self.receive_metadata_event(msg.event)
 
-                    if msg.event.kind == EventKind.ENCRYPTED_DIRECT_MESSAGE:
-                        self.receive_private_message_event(msg.event)
+            if msg.event.kind == EventKind.CONTACTS:
+                self.receive_contact_list_event(msg.event, msg.subscription_id)
 
-                    if msg.event.kind == EventKind.DELETE:
-                        self.receive_del_event(msg.event)
+            if msg.event.kind == EventKind.TEXT_NOTE:
+                self.receive_note_event(msg.event, msg.subscription_id)
 
-                    if msg.event.kind == EventKind.REACTION:
-                        self.receive_reaction_event(msg.event)
+            if msg.event.kind == EventKind.ENCRYPTED_DIRECT_MESSAGE:
+                self.receive_private_message_event(msg.event)
 
-                    if msg.subscription_id != 'search':
-                        DB.add_event(msg.event.id, msg.event.kind)
-            DB.commit()
-            D_TASKS.next()
-            time.sleep(1)
-            logger.info('Event loop {}'.format(int(time.time())))
-            i += 1
-            if i == 60:
-                self.get_connection_status()
-                socketio.emit('subscriptions', list(self.subscriptions))
-                i = 0
+            if msg.event.kind == EventKind.DELETE:
+                self.receive_del_event(msg.event)
+
+            if msg.event.kind == EventKind.REACTION:
+                self.receive_reaction_event(msg.event)
+
+            if msg.subscription_id != 'search':
+                DB.add_event(msg.event.id, msg.event.kind)
+                SEEN_EVENTS.add(msg.event.id)
+        else:
+            SEEN_EVENTS.add(msg.event.id)
+
+    # queue a UI signal until the current batch is committed
+    # signals in COALESCED_SIGNALS only keep their latest value
+    def signal(self, name, data):
+        if name in COALESCED_SIGNALS:
+            self.pending_signals[name] = data
+        else:
+            self.pending_signals.setdefault(name, []).append(data)
+
+    def send_pending_signals(self):
+        if self.unseen_posts_changed:
+            self.unseen_posts_changed = False
+            unseen_posts = DB.get_unseen_in_feed(self.get_key())
+            if unseen_posts > 0:
+                self.signal('unseen_posts_n', unseen_posts)
+        signals = self.pending_signals
+        self.pending_signals = {}
+        for name, data in signals.items():
+            if name in COALESCED_SIGNALS:
+                socketio.emit(name, data)
+            else:
+                for item in data:
+                    socketio.emit(name, item)
 
     def receive_del_event(self, event):
         DeleteEvent(event)
@@ -153,7 +279,7 @@ class BijaEvents:
         if e.valid:
             note = DB.get_note(e.event_id)
             if e.event.content != '-' and 'notes' in self.active_events and e.event_id in self.active_events['notes']:
-                socketio.emit('new_reaction', e.event_id)
+                self.signal('new_reaction', e.event_id)
                 logger.info('Reaction on active note detected, signal to UI')
             if e.event.public_key != self.get_key():
                 logger.info('Reaction is not from me')
@@ -167,14 +293,14 @@ class BijaEvents:
                     logger.info('Get unread alert count')
                     n = DB.get_unread_alert_count()
                     if n > 0:
-                        socketio.emit('alert_n', n)
+                        self.signal('alert_n', n)
 
     def receive_metadata_event(self, event):
         meta = MetadataEvent(event)
-        if self.page['page'] == 'profile' and self.page['identifier'] == event.public_key:
+        if meta.fresh and self.page['page'] == 'profile' and self.page['identifier'] == event.public_key:
             if meta.picture is None or len(meta.picture.strip()) == 0:
                 meta.picture = '/identicon?id={}'.format(event.public_key)
-            socketio.emit('profile_update', {
+            self.signal('profile_update', {
                 'public_key': event.public_key,
                 'name': meta.name,
                 'nip05': meta.nip05,
@@ -186,7 +312,7 @@ class BijaEvents:
 
     def receive_note_event(self, event, subscription):
         if subscription == 'search':
-            socketio.emit('search_result', {
+            self.signal('search_result', {
                 'id': event.id,
                 'content': textwrap.shorten(
                     strip_tags(event.content),
@@ -204,13 +330,13 @@ class BijaEvents:
         if 'notes' in self.active_events:
             if e.response_to in self.active_events['notes']:
                 logger.info('Detected response to active note {}'.format(e.response_to))
-                socketio.emit('new_reply', e.response_to)
+                self.signal('new_reply', e.response_to)
             elif e.response_to is None and e.thread_root in self.active_events['notes']:
                 logger.info('Detected response to active note {}'.format(e.thread_root))
-                socketio.emit('new_reply', e.thread_root)
+                self.signal('new_reply', e.thread_root)
             if e.reshare in self.active_events['notes']:
                 logger.info('Detected reshare on active note {}'.format(e.reshare))
-                socketio.emit('new_reshare', e.reshare)
+                self.signal('new_reshare', e.reshare)
 
     def alert_on_note_event(self, event):
         if event.response_to is not None:
@@ -229,19 +355,16 @@ class BijaEvents:
 
     def notify_on_note_event(self, event, subscription):
         if subscription == 'primary':
-            unseen_posts = DB.get_unseen_in_feed()
-            if unseen_posts > 0:
-                socketio.emit('unseen_posts_n', unseen_posts)
+            self.unseen_posts_changed = True
         elif subscription == 'profile':
             DB.set_note_seen(event.id)
-            socketio.emit('new_profile_posts', DB.get_most_recent_for_pk(event.public_key))
+            self.signal('new_profile_posts', DB.get_most_recent_for_pk(event.public_key))
         elif subscription == 'note-thread':
-            socketio.emit('new_in_thread', event.id)
+            self.signal('new_in_thread', event.id)
 
     def receive_contact_list_event(self, event, subscription):
         e = ContactListEvent(event, self.get_key())
         DB.add_profile_if_not_exists(event.public_key)
-        DB.add_contact_list(event.public_key, e.keys)
         if e.changed:
             self.subscribe_primary()
         if event.public_key != self.get_key() and subscription == 'profile':
@@ -259,10 +382,10 @@ class BijaEvents:
                 DB.set_message_thread_read(e.pubkey)
                 out = render_template("message_thread.items.html",
                                       me=profile, messages=messages, privkey=self.get_key('private'))
-                socketio.emit('message', out)
+                self.signal('message', out)
         else:
             unseen_n = DB.get_unseen_message_count()
-            socketio.emit('unseen_messages_n', unseen_n)
+            self.signal('unseen_messages_n', unseen_n)
 
     def subscribe_thread(self, root_id, ids):
         self.active_events['notes'] = ids
@@ -332,6 +455,7 @@ class BijaEvents:
 
     def close(self):
         self.should_run = False
+        self.stopped.set()
         self.relay_manager.close_connections()
 
 
@@ -406,6 +530,7 @@ class ContactListEvent:
         self.changed = False
 
         self.compile_keys()
+        self.added, self.removed = DB.set_contacts(event.public_key, self.keys)
         if event.public_key == self.pubkey:
             self.set_following()
 
@@ -493,15 +618,15 @@ class MetadataEvent:
         self.about = None
         self.picture = None
         self.nip05_validated = False
-        if self.is_fresh():
+        self.current = DB.get_profile_version(event.public_key)
+        self.fresh = self.is_fresh()
+        if self.fresh:
             self.process_content()
             self.store()
 
+    # older or repeated metadata is dropped before the content is parsed
     def is_fresh(self):
-        ts = DB.get_profile_last_upd(self.event.public_key)
-        if ts is None or ts.updated_at < self.event.created_at:
-            return True
-        return False
+        return self.current.updated_at is None or self.current.updated_at < self.event.created_at
 
     def process_content(self):
         s = json.loads(self.event.content)
@@ -515,19 +640,15 @@ class MetadataEvent:
             self.picture = s['picture'].strip()
 
         if self.nip05 is not None:
-            current = DB.get_profile(self.event.public_key)
-            if current is None or current.nip05 != self.nip05:
-                if self.validate_nip05(self.nip05, self.event.public_key):
-                    DB.set_valid_nip05(self.event.public_key)
-                    self.nip05_validated = True
-            elif current is not None:
-                self.nip05_validated = current.nip05
+            if self.current.nip05 == self.nip05:
+                self.nip05_validated = self.current.nip05_validated
             else:
-                self.nip05_validated = False
+                # unknown identifiers are checked in the background and the profile updated when the answer arrives
+                self.nip05_validated = NIP05_VERIFIER.verify(self.nip05, self.event.public_key) is True
 
     @staticmethod
     def validate_nip05(nip05, pk):
-        validated_name = request_nip05(nip05)
+        validated_name = NIP05_VERIFIER.resolve(nip05)
         if validated_name is not None and validated_name == pk:
             return True
         return False
@@ -540,43 +661,52 @@ class MetadataEvent:
             self.picture,
             self.about,
             self.event.created_at,
-            json.dumps(self.event.to_json_object())
+            json.dumps(self.event.to_json_object()),
+            self.nip05_validated
         )
 
 
 class NoteEvent:
     def __init__(self, event, my_pk):
-        if DB.get_event(event.id) is None:
-            logger.info('New note')
-            self.event = event
-            self.content = strip_tags(event.content)
-            self.tags = event.tags
-            self.media = []
-            self.members = []
-            self.thread_root = None
-            self.response_to = None
-            self.reshare = None
-            self.used_tags = []
-            self.my_pk = my_pk
-            self.mentions_me = False
-
-            self.process_content()
-            self.tags = [x for x in self.tags if x not in self.used_tags]
-            self.process_tags()
-            self.update_db()
-            self.update_referenced()
+        logger.info('New note')
+        self.event = event
+        self.content = strip_tags(event.content)
+        self.tags = event.tags
+        self.media = []
+        self.members = []
+        self.thread_root = None
+        self.response_to = None
+        self.reshare = None
+        self.used_tags = []
+        self.my_pk = my_pk
+        self.mentions_me = False
+
+        self.process_content()
+        self.tags = [x for x in self.tags if x not in self.used_tags]
+        self.process_tags()
+        self.update_db()
+        self.update_referenced()
 
+    # the content is scanned once, embedded tags and urls are then replaced in a single rebuild
     def process_content(self):
         logger.info('process note content')
-        self.process_embedded_tags()
-        self.process_embedded_urls()
+        tokens = tokenize_content(self.content)
+        embeds = self.process_embedded_tags(tokens)
+        urls = [t.value for t in tokens if t.kind == 'url']
 
-    def process_embedded_urls(self):
+        def replace(token):
+            if token.kind == 'embed':
+                return embeds.get(token.value)
+            elif token.kind == 'url':
+                return url_link(token.value)
+            return None
+
+        self.content = replace_tokens(self.content, tokens, replace)
+        self.process_embedded_urls(urls)
+
+    def process_embedded_urls(self, urls):
         logger.info('process note urls')
-        urls = get_urls_in_string(self.content)
         logger.info(urls)
-        self.content = url_linkify(self.content)
-        logger.info(self.content)
         for url in urls:
             logger.info('process {}'.format(url))
             if validators.url(url):
@@ -590,58 +720,59 @@ class NoteEvent:
                     logger.info('{} is vid'.format(url))
                     self.media.append((url, 'video', extension.lower()[1:]))
 
-        if len(self.media) < 1 and len(urls) > 0:
+        if len(self.media) < 1 and len(urls) > 0 and validators.url(urls[0]):
             logger.info('note has urls')
-            note = DB.get_note(self.event.id)
-            already_scraped = False
-            scrape_fail_attempts = 0
-            if note is not None:
-                logger.info('note {} already in db'.format(self.event.id))
-                media = json.loads(note['media'])
-                for item in media:
-                    if item[1] == 'og':
-                        already_scraped = True
-                    elif item[1] == 'scrape_failed':
-                        scrape_fail_attempts = int(item[0])
-
-            if (note is None or not already_scraped) and validators.url(urls[0]) and scrape_fail_attempts < 4:
-                logger.info('add {} to tasks for scraping'.format(urls[0]))
-                D_TASKS.pool.add(TaskKind.FETCH_OG, {'url': urls[0], 'note_id': self.event.id})
-
-    def process_embedded_tags(self):
+            self.process_og_preview(urls[0])
+
+    # attach a cached preview straight away, fetch it only when there's nothing usable in the cache
+    def process_og_preview(self, url):
+        cached = DB.get_og_cache(normalize_url(url))
+        now = time.time()
+        if cached is not None:
+            if cached.og_url is not None:
+                if now - cached.fetched_at < OG_CACHE_TTL:
+                    logger.info('{} preview from cache'.format(url))
+                    self.media.append((og_cache_data(cached), 'og'))
+                    return
+            elif now - cached.fetched_at < OG_NEGATIVE_TTL or cached.attempts >= OG_MAX_ATTEMPTS:
+                logger.info('{} has no preview'.format(url))
+                return
+        logger.info('add {} to tasks for scraping'.format(url))
+        D_TASKS.pool.add(TaskKind.FETCH_OG, {'url': url, 'note_id': self.event.id})
+
+    # maps each embedded tag index to the text that replaces it
+    def process_embedded_tags(self, tokens):
         logger.info('process note embedded tags')
-        embeds = get_embeded_tag_indexes(self.content)
-        for item in embeds:
-            self.process_embedded_tag(int(item))
+        embeds = {}
+        for token in tokens:
+            if token.kind == 'embed' and token.value not in embeds:
+                embeds[token.value] = self.process_embedded_tag(int(token.value))
+        return embeds
 
     def process_embedded_tag(self, item):
         logger.info('process note tag {}'.format(item))
         if list_index_exists(self.tags, item) and self.tags[item][0] == "p":
             self.used_tags.append(self.tags[item])
-            self.process_p_tag(item)
+            return self.process_p_tag(item)
         elif list_index_exists(self.tags, item) and self.tags[item][0] == "e":
             self.used_tags.append(self.tags[item])
-            self.process_e_tag(item)
+            return self.process_e_tag(item)
+        return None
 
     def process_p_tag(self, item):
         logger.info('process note p tag')
         pk = self.tags[item][1]
-        self.content = self.content.replace(
-            "#[{}]".format(item),
-            "@{}".format(pk))
         if pk == self.my_pk and self.event.public_key != self.my_pk:
             self.mentions_me = True
+        return "@{}".format(pk)
 
     def process_e_tag(self, item):
         logger.info('process note e tag')
         event_id = self.tags[item][1]
         if self.reshare is None:
             self.reshare = event_id
-            self.content = self.content.replace("#[{}]".format(item), "")
-        else:
-            self.content = self.content.replace(
-                "#[{}]".format(item),
-                "<a href='/note?id={}#{}'>event:{}&#8230;</a>".format(event_id, event_id, event_id[:21]))
+            return ""
+        return "<a href='/note?id={}#{}'>event:{}&#8230;</a>".format(event_id, event_id, event_id[:21])
 
     def process_tags(self):
         logger.info('process note tags')
@@ -689,6 +820,7 @@ class NoteEvent:
             json.dumps(self.media),
             json.dumps(self.event.to_json_object())
         )
+        DB.add_to_timeline(self.event.id, self.event.public_key, self.event.created_at, self.my_pk)
 
     def update_referenced(self):
         logger.info('update refs new note')
@@ -1,18 +1,18 @@
+import json
 import os
 import re
 import time
-import urllib
 from enum import IntEnum
+from html.entities import html5
+from html.parser import HTMLParser
 import logging
 import traceback
-from typing import Any
-from urllib.error import HTTPError, URLError
+from typing import Any, NamedTuple
 from urllib.parse import urlparse
-from urllib.request import Request
 
 import requests
-from bs4 import BeautifulSoup
 
+from bija.http_client import HTTP_CLIENT, ResponseTooLarge
 from python_nostr.nostr import bech32
 from python_nostr.nostr.bech32 import bech32_encode, bech32_decode, convertbits
 
@@ -41,51 +41,262 @@ def is_bech32_key(hrp: str, key_str: str) -> bool:
     return False
 
 
+NAME_RE = re.compile(r'([a-zA-Z_0-9][a-zA-Z_\-0-9]+[a-zA-Z_0-9])+')
+AT_TAG_RE = re.compile(r'(@[a-zA-Z_0-9][a-zA-Z_\-0-9]+[a-zA-Z_0-9])+')
+HASH_TAG_RE = re.compile(r'(#[a-zA-Z_0-9][a-zA-Z_\-0-9]+[a-zA-Z_0-9])+')
+EMBEDDED_TAG_RE = re.compile(r'#\[([0-9]+)]')
+URL_RE = re.compile(r'((https?):((//)|(\\\\))+([\w\d:#@%/;$()~_?\+-=\\\.&](#!)?)*)')
+NIP05_RE = re.compile(r'([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(\.[A-Z|a-z]{2,})+')
+RELAY_RE = re.compile(
+    r'^wss?://'
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
+# urls, embedded #[n] tag references, @mentions and #hashtags found in one scan, left to right.
+# mentions and hashtags stop where a url starts so that text like '@bobhttps://...' still yields the url.
+NOT_URL = r'(?!https?:)'
+CONTENT_TOKEN_RE = re.compile(
+    r'(?P<url>https?:(?://|\\\\)+(?:[\w\d:#@%/;$()~_?\+-=\\\.&](?:#!)?)*)'
+    r'|(?P<embed>#\[(?P<index>[0-9]+)])'
+    r'|(?P<mention>@{0}[a-zA-Z_0-9](?:{0}[a-zA-Z_\-0-9])+{0}[a-zA-Z_0-9])'
+    r'|(?P<hashtag>#{0}[a-zA-Z_0-9](?:{0}[a-zA-Z_\-0-9])+{0}[a-zA-Z_0-9])'.format(NOT_URL))
+
+
+class ContentToken(NamedTuple):
+    kind: str
+    start: int
+    end: int
+    value: str
+
+
 def is_valid_name(name: str) -> bool:
-    regex = re.compile(r'([a-zA-Z_0-9][a-zA-Z_\-0-9]+[a-zA-Z_0-9])+')
-    return re.fullmatch(regex, name) is not None
+    return NAME_RE.fullmatch(name) is not None
 
 
 def get_at_tags(content: str) -> list[Any]:
-    regex = re.compile(r'(@[a-zA-Z_0-9][a-zA-Z_\-0-9]+[a-zA-Z_0-9])+')
-    return re.findall(regex, content)
+    return AT_TAG_RE.findall(content)
 
 
 def get_hash_tags(content: str) -> list[Any]:
-    regex = re.compile(r'(#[a-zA-Z_0-9][a-zA-Z_\-0-9]+[a-zA-Z_0-9])+')
-    return re.findall(regex, content)
+    return HASH_TAG_RE.findall(content)
 
 
 def get_embeded_tag_indexes(content: str):
-    regex = re.compile(r'#\[([0-9]+)]')
-    return re.findall(regex, content)
+    return EMBEDDED_TAG_RE.findall(content)
 
 
 def get_urls_in_string(content: str):
-    regex = re.compile(r'((https?):((//)|(\\\\))+([\w\d:#@%/;$()~_?\+-=\\\.&](#!)?)*)')
-    url = re.findall(regex, content)
-    return [x[0] for x in url]
-
-
-def url_linkify(content):
-    urls = get_urls_in_string(content)
-    for url in urls:
-        parts = url.split('//')
-        if len(parts) < 2:
-            parts = ['', url]
-            url = 'https://' + url
-        if len(parts[1]) > 21:
-            link_text = parts[1][:21] + '&#8230;'
+    return [x[0] for x in URL_RE.findall(content)]
+
+
+# the value of an embed token is its tag index, for everything else it's the matched text
+def tokenize_content(content: str) -> list[ContentToken]:
+    tokens = []
+    for m in CONTENT_TOKEN_RE.finditer(content):
+        kind = m.lastgroup if m.lastgroup != 'index' else 'embed'
+        value = m.group('index') if kind == 'embed' else m.group()
+        tokens.append(ContentToken(kind, m.start(), m.end(), value))
+    return tokens
+
+
+# rebuilds the content in one pass, replace(token) returns the new text for a token or None to keep it
+def replace_tokens(content: str, tokens: list[ContentToken], replace) -> str:
+    out = []
+    pos = 0
+    for token in tokens:
+        r = replace(token)
+        if r is not None:
+            out.append(content[pos:token.start])
+            out.append(r)
+            pos = token.end
+    out.append(content[pos:])
+    return ''.join(out)
+
+
+def get_mentioned_pubkeys(tokens: list[ContentToken]):
+    return list(dict.fromkeys(
+        t.value[1:] for t in tokens if t.kind == 'mention' and is_hex_key(t.value[1:])))
+
+
+# lower case scheme and host, no default port, no fragment, so the same page shares one cache entry
+def normalize_url(url: str) -> str:
+    try:
+        parts = urlparse(url.strip())
+        port = parts.port
+    except ValueError:
+        # out of range ports or broken ipv6 hosts, the url is still usable as a cache key
+        return url.strip().lower()
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if port is not None and (scheme, port) not in (('http', 80), ('https', 443)):
+        netloc = '{}:{}'.format(netloc, port)
+    if parts.username is not None:
+        netloc = '{}@{}'.format(parts.netloc.rsplit('@', 1)[0], netloc)
+    path = parts.path if len(parts.path) > 0 else '/'
+    return parts._replace(scheme=scheme, netloc=netloc, path=path, fragment='').geturl()
+
+
+def url_link(url):
+    parts = url.split('//')
+    if len(parts) < 2:
+        parts = ['', url]
+        url = 'https://' + url
+    if len(parts[1]) > 21:
+        link_text = parts[1][:21] + '&#8230;'
+    else:
+        link_text = parts[1]
+    return "<a href='{}'>{}</a>".format(url, link_text)
+
+
+def url_linkify(content, tokens=None):
+    if tokens is None:
+        tokens = tokenize_content(content)
+    return replace_tokens(content, tokens, lambda t: url_link(t.value) if t.kind == 'url' else None)
+
+
+# Plain text extraction without building a tree.
+# Output matches BeautifulSoup(content, 'html.parser').get_text(): entities are decoded, comments, doctypes and
+# processing instructions are dropped, text inside script, style, template, rt and rp is dropped, CDATA is kept,
+# and whitespace-only runs between tags collapse to a single space or newline outside pre and textarea.
+class TextExtractor(HTMLParser):
+    VOID_TAGS = {
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta', 'param',
+        'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer'
+    }
+    PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+    HIDDEN_TEXT_TAGS = {'rt', 'rp', 'style', 'script', 'template'}
+    ASCII_SPACES = ' \n\t\x0c\r'
+    ENTITIES = {k.rstrip(';'): v for k, v in html5.items()}
+    DECIMAL_REF = re.compile('^([0-9]+)(.*)')
+    HEX_REF = re.compile('^([0-9a-f]+)(.*)')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.text = []
+        self.data = []
+        self.stack = []
+        self.preserving = 0
+        self.hiding = 0
+        self.closed_void_tags = []
+
+    def extract(self, content: str):
+        self.feed(content)
+        self.close()
+        self.end_data()
+        return ''.join(self.text)
+
+    def end_data(self, visible=None):
+        if len(self.data) == 0:
+            return
+        data = ''.join(self.data)
+        self.data = []
+        if self.preserving == 0 and data.strip(self.ASCII_SPACES) == '':
+            data = '\n' if '\n' in data else ' '
+        if visible is None:
+            visible = self.hiding == 0
+        if visible:
+            self.text.append(data)
+
+    def push(self, tag):
+        self.stack.append(tag)
+        if tag in self.PRESERVE_WHITESPACE_TAGS:
+            self.preserving += 1
+        if tag in self.HIDDEN_TEXT_TAGS:
+            self.hiding += 1
+
+    def pop_to(self, tag):
+        self.end_data()
+        if tag not in self.stack:
+            return
+        while len(self.stack) > 0:
+            t = self.stack.pop()
+            if t in self.PRESERVE_WHITESPACE_TAGS:
+                self.preserving -= 1
+            if t in self.HIDDEN_TEXT_TAGS:
+                self.hiding -= 1
+            if t == tag:
+                break
+
+    def handle_starttag(self, tag, attrs):
+        self.end_data()
+        self.push(tag)
+        if tag in self.VOID_TAGS:
+            self.pop_to(tag)
+            self.closed_void_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.end_data()
+        self.push(tag)
+        self.pop_to(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.closed_void_tags:
+            self.closed_void_tags.remove(tag)
         else:
-            link_text = parts[1]
-        content = content.replace(
-            url,
-            "<a href='{}'>{}</a>".format(url, link_text))
-    return content
+            self.pop_to(tag)
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_entityref(self, name):
+        self.data.append(self.ENTITIES.get(name, '&{}'.format(name)))
+
+    def handle_charref(self, name):
+        base, ref = 10, self.DECIMAL_REF
+        if name[:1] in ('x', 'X'):
+            name = name[1:]
+            base, ref = 16, self.HEX_REF
+        extra = ''
+        try:
+            n = int(name, base)
+        except ValueError:
+            match = ref.search(name)
+            if match is None:
+                self.data.append(name)
+                return
+            n = int(match.group(1), base)
+            extra = match.group(2)
+        self.data.append(self.numeric_reference(n))
+        self.data.append(extra)
+
+    # https://html.spec.whatwg.org/multipage/parsing.html#numeric-character-reference-end-state
+    @staticmethod
+    def numeric_reference(n):
+        if n == 0 or n > 0x10ffff or 0xd800 <= n <= 0xdfff:
+            return '\ufffd'
+        if 0x80 <= n <= 0x9f:
+            try:
+                return bytes([n]).decode('cp1252')
+            except UnicodeDecodeError:
+                pass
+        return chr(n)
+
+    def handle_comment(self, data):
+        self.end_data()
+
+    def handle_decl(self, decl):
+        self.end_data()
+
+    def handle_pi(self, data):
+        self.end_data()
+
+    def unknown_decl(self, data):
+        self.end_data()
+        if data.upper().startswith('CDATA['):
+            self.data.append(data[len('CDATA['):])
+            self.end_data(visible=True)
 
 
 def strip_tags(content: str):
-    return BeautifulSoup(content, features="html.parser").get_text()
+    # nothing to parse in most notes
+    if '<' not in content and '&' not in content:
+        if len(content) > 0 and content.strip(TextExtractor.ASCII_SPACES) == '':
+            return '\n' if '\n' in content else ' '
+        return content
+    return TextExtractor().extract(content)
 
 
 def is_nip05(name: str):
@@ -98,22 +309,14 @@ def is_nip05(name: str):
     else:
         test_str = 'test@{}'.format(parts[0])
         parts.insert(0, '_')
-    regex = re.compile(r'([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(\.[A-Z|a-z]{2,})+')
-    if re.fullmatch(regex, test_str) is not None:
+    if NIP05_RE.fullmatch(test_str) is not None:
         return parts
     else:
         return False
 
 
 def is_valid_relay(url: str) -> bool:
-    regex = re.compile(
-        r'^wss?://'
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
-        r'localhost|'  # localhost...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
-        r'(?::\d+)?'  # optional port
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-    return re.fullmatch(regex, url) is not None
+    return RELAY_RE.fullmatch(url) is not None
 
 
 def is_hex_key(k):
@@ -142,46 +345,49 @@ def request_nip05(nip05):
     valid_parts = is_nip05(nip05)
     if valid_parts:
         name = valid_parts[0]
-        address = valid_parts[1]
-        try:
-            response = requests.get(
-                'https://{}/.well-known/nostr.json'.format(address), params={'name': name}, timeout=2
-            )
-            if response.status_code == 200:
-                try:
-                    d = response.json()
-                    if name in d['names']:
-                        return d['names'][name]
-                except ValueError:
-                    return None
-                except Exception as e:
-                    logging.error(traceback.format_exc())
-            else:
+        names = request_nip05_names(valid_parts[1], name)
+        if names is not None and name in names:
+            return names[name]
+    return None
+
+
+# the names map from a domain's nostr.json, for one name or, without a name, everything the domain lists
+def request_nip05_names(address, name=None):
+    params = {'name': name} if name is not None else None
+    try:
+        response, body = HTTP_CLIENT.get('https://{}/.well-known/nostr.json'.format(address), params=params)
+        if response.status_code == 200:
+            try:
+                d = json.loads(body)
+                if isinstance(d.get('names'), dict):
+                    return d['names']
+            except ValueError:
                 return None
-        except ConnectionError:
-            return None
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            return None
-    else:
+            except Exception as e:
+                logging.error(traceback.format_exc())
+        return None
+    except (requests.RequestException, ResponseTooLarge):
+        return None
+    except Exception as e:
+        logging.error(traceback.format_exc())
         return None
 
 
 def request_relay_data(url):
     parts = urlparse(url)
     url = url.replace(parts.scheme, 'https')
-    get = Request(url, headers={'Accept': 'application/nostr+json'})
     try:
-        with urllib.request.urlopen(get, timeout=2) as response:
-            if response.status == 200:
-                return response.read()
-            return False
-    except HTTPError as error:
-        print(error.status, error.reason)
+        response, body = HTTP_CLIENT.get(url, headers={'Accept': 'application/nostr+json'})
+        if response.status_code == 200:
+            return body
+        print(response.status_code, response.reason)
         return False
-    except URLError as error:
-        print(error.reason)
-        return False
-    except TimeoutError:
+    except requests.Timeout:
         print("Request timed out")
         return False
+    except requests.RequestException as error:
+        print(error)
+        return False
+    except ResponseTooLarge:
+        print("Response too large")
+        return False
@@ -0,0 +1,268 @@
+import logging
+import socket
+import time
+from collections import deque
+from contextlib import contextmanager
+from email.message import Message
+from threading import Lock, BoundedSemaphore, Condition, Timer
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError
+
+from bija.config import HTTP_POOL_HOSTS, HTTP_POOL_SIZE, HTTP_MAX_ACTIVE, HTTP_PER_HOST, HTTP_TIMEOUT, \
+    HTTP_MAX_BYTES, HTTP_DNS_TTL, HTTP_LATENCY_SAMPLES
+
+# no bija.args here: args imports helpers (through setup) which imports this module, app.py sets the level
+logger = logging.getLogger(__name__)
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+# caps how many requests run against the same host at once
+class HostLimits:
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.active = {}
+        self.cond = Condition()
+
+    @contextmanager
+    def slot(self, url):
+        host = urlparse(url).hostname or ''
+        with self.cond:
+            while self.active.get(host, 0) >= self.per_host:
+                self.cond.wait()
+            self.active[host] = self.active.get(host, 0) + 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active[host] -= 1
+                if self.active[host] == 0:
+                    del self.active[host]
+                self.cond.notify_all()
+
+
+# getaddrinfo results per (host, port), kept for HTTP_DNS_TTL seconds
+class DNSCache:
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, host, port):
+        key = (host, port)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with self.lock:
+            self.entries[key] = (addresses, time.monotonic() + self.ttl)
+        return addresses
+
+    def discard(self, host, port):
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+
+# connections that resolve their host through the dns cache and report every new socket they open
+class CachedDNSConnection:
+    dns = None
+    on_connect = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        self.on_connect()
+        try:
+            addresses = self.dns.resolve(host, self.port)
+        except socket.gaierror:
+            return super()._new_conn()
+        err = None
+        try:
+            for _, _, _, _, sockaddr in addresses:
+                # only the socket goes to the address, tls still checks and sends the hostname
+                self._dns_host = sockaddr[0]
+                try:
+                    return super()._new_conn()
+                except ConnectTimeoutError as e:
+                    err = e
+        finally:
+            self._dns_host = host
+        self.dns.discard(host, self.port)
+        raise err
+
+
+# mounts connection pools using CachedDNSConnection on the client's session only,
+# other urllib3 users in the process keep the default resolver
+class CachedDNSAdapter(HTTPAdapter):
+
+    def __init__(self, dns, on_connect, **kwargs):
+        self.dns = dns
+        self.on_connect = on_connect
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': self.pool_class(HTTPConnectionPool, HTTPConnection),
+            'https': self.pool_class(HTTPSConnectionPool, HTTPSConnection)
+        }
+
+    def pool_class(self, pool_cls, connection_cls):
+        connection = type('Cached' + connection_cls.__name__, (CachedDNSConnection, connection_cls), {
+            'dns': self.dns,
+            'on_connect': staticmethod(self.on_connect)
+        })
+        return type('Cached' + pool_cls.__name__, (pool_cls,), {'ConnectionCls': connection})
+
+
+# Outbound HTTP shared by nip-05 lookups, relay info and link previews.
+# One requests session keeps connections alive per host, hostnames are resolved through a small cache,
+# and every request takes a per host slot, then a global one. Bodies are read in chunks and abandoned past max_bytes.
+class HttpClient:
+
+    def __init__(self):
+        self.dns = DNSCache(HTTP_DNS_TTL)
+        self.session = requests.Session()
+        adapter = CachedDNSAdapter(self.dns, self.connection_opened,
+                                   pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['User-Agent'] = 'Bija Nostr Client'
+        self.active = BoundedSemaphore(HTTP_MAX_ACTIVE)
+        self.host_limits = HostLimits(HTTP_PER_HOST)
+        self.lock = Lock()
+        self.latencies = deque(maxlen=HTTP_LATENCY_SAMPLES)
+        self.requests = 0
+        self.connections = 0
+        self.errors = 0
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+
+    # yields a streaming response, raises requests.RequestException on failure
+    # timeout applies to each read, deadline (seconds from the start of the request) to the whole response
+    # the per host slot comes first so requests queued behind a slow host don't hold global slots while they wait
+    @contextmanager
+    def stream(self, url, params=None, headers=None, timeout=HTTP_TIMEOUT, deadline=None):
+        with self.host_limits.slot(url), self.active:
+            with self.lock:
+                self.requests += 1
+            start = time.monotonic()
+            try:
+                with self.session.get(url, params=params, headers=headers, timeout=timeout, stream=True) as response:
+                    self.record(time.monotonic() - start)
+                    if deadline is None:
+                        yield response
+                    else:
+                        with self.expire_at(response, start + deadline):
+                            yield response
+            except requests.RequestException:
+                with self.lock:
+                    self.errors += 1
+                raise
+
+    # a server can keep each read just inside the timeout, once the deadline passes the socket is shut down
+    # and the body ends where it got to (or the read fails for chunked bodies),
+    # the connection is left alone once the response is done with
+    @staticmethod
+    @contextmanager
+    def expire_at(response, deadline):
+        lock = Lock()
+        reading = [True]
+
+        def expire():
+            with lock:
+                connection = response.raw.connection if reading[0] else None
+                sock = getattr(connection, 'sock', None)
+                if sock is not None:
+                    logger.info('deadline passed for {}'.format(response.url))
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+        timer = Timer(max(0, deadline - time.monotonic()), expire)
+        timer.daemon = True
+        timer.start()
+        try:
+            yield
+        finally:
+            with lock:
+                reading[0] = False
+            timer.cancel()
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    # the whole body, raises ResponseTooLarge if it runs past max_bytes
+    def get(self, url, params=None, headers=None, timeout=HTTP_TIMEOUT, max_bytes=HTTP_MAX_BYTES):
+        with self.stream(url, params=params, headers=headers, timeout=timeout) as response:
+            body = b''.join(self.iter_body(response, max_bytes, strict=True))
+            return response, body
+
+    # body chunks up to max_bytes, with strict a longer body raises instead of stopping short
+    @staticmethod
+    def iter_body(response, max_bytes=HTTP_MAX_BYTES, chunk_size=16 * 1024, strict=False):
+        length = response.headers.get('Content-Length')
+        if strict and length is not None and length.isdigit() and int(length) > max_bytes:
+            raise ResponseTooLarge(response.url)
+        received = 0
+        for chunk in response.iter_content(chunk_size):
+            received += len(chunk)
+            if received > max_bytes:
+                if strict:
+                    raise ResponseTooLarge(response.url)
+                yield chunk[:max_bytes - (received - len(chunk))]
+                return
+            yield chunk
+
+    # (content type, charset or None) from the response headers, (None, None) without a Content-Type header
+    @staticmethod
+    def content_type(response):
+        if 'Content-Type' not in response.headers:
+            return None, None
+        m = Message()
+        m['Content-Type'] = response.headers.get('Content-Type', '')
+        return m.get_content_type(), m.get_content_charset()
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            requests_made = self.requests
+            connections = self.connections
+            errors = self.errors
+
+        def percentile(p):
+            if len(latencies) == 0:
+                return 0
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000)
+
+        return {
+            'requests': requests_made,
+            'errors': errors,
+            'connections': connections,
+            'reuse': round(max(0, 1 - connections / requests_made), 3) if requests_made > 0 else 0,
+            'dns_hits': self.dns.hits,
+            'dns_misses': self.dns.misses,
+            'p50_ms': percentile(0.5),
+            'p90_ms': percentile(0.9),
+            'p99_ms': percentile(0.99)
+        }
+
+
+HTTP_CLIENT = HttpClient()
@@ -8,11 +8,13 @@ import arrow
 from bija.app import app
 from bija.args import LOGGING_LEVEL
 from bija.db import BijaDB
-from bija.helpers import get_at_tags, is_hex_key, url_linkify, strip_tags
+from bija.helpers import tokenize_content, replace_tokens, get_mentioned_pubkeys, url_linkify, strip_tags
+from bija.note_html import NOTE_HTML
+from bija.profile_briefs import PROFILE_BRIEFS
 from bija.settings import Settings
 from python_nostr.nostr.key import PrivateKey
 
-DB = BijaDB(app.session)
+DB = BijaDB(app.read_session)
 logger = logging.getLogger(__name__)
 logger.setLevel(LOGGING_LEVEL)
 
@@ -75,8 +77,20 @@ def _jinja2_filter_responders(the_dict, n):
 
 
 @app.template_filter('process_media_attachments')
-def _jinja2_filter_media(json_string):
+def _jinja2_filter_media(json_string, note_id=None):
     logger.info('format media')
+    if note_id is None:
+        return render_media_attachments(json_string)
+    key = (note_id, 'media')
+    html = NOTE_HTML.get(key)
+    if html is None:
+        revision = NOTE_HTML.revision
+        html = render_media_attachments(json_string)
+        NOTE_HTML.put(key, html, revision)
+    return html
+
+
+def render_media_attachments(json_string):
     a = json.loads(json_string)
     if len(a) > 0:
         media = a[0]
@@ -90,24 +104,43 @@ def _jinja2_filter_media(json_string):
 
 
 @app.template_filter('process_note_content')
-def _jinja2_filter_note(content: str, limit=200):
+def _jinja2_filter_note(content: str, limit=200, note_id=None):
     logger.info('format note content')
-    tags = get_at_tags(content)
-
-    if limit is not None and len(strip_tags(content)) > limit:
-        content = textwrap.shorten(strip_tags(content), width=limit, replace_whitespace=False, break_long_words=True,
-                                   placeholder="... <a href='#' class='read-more'>more</a>")
-    for tag in tags:
-        pk = tag[1:]
-        if is_hex_key(pk):
-            name = '{}&#8230;{}'.format(pk[:3], pk[-5:])
-            profile = DB.get_profile(pk)
-            if profile is not None and profile.name is not None and len(profile.name) > 0:
-                name = profile.name
-            content = content.replace(
-                "@{}".format(pk),
-                "<a class='uname' href='/profile?pk={}'>@{}</a>".format(pk, name))
-    return content
+    if note_id is None:
+        return render_note_content(content, limit)[0]
+    key = (note_id, 'content', limit)
+    html = NOTE_HTML.get(key)
+    if html is None:
+        revision = NOTE_HTML.revision
+        html, mentions = render_note_content(content, limit)
+        NOTE_HTML.put(key, html, revision, mentions)
+    return html
+
+
+# returns the html and the pubkeys it mentions
+def render_note_content(content: str, limit):
+    if limit is not None:
+        text = strip_tags(content)
+        if len(text) > limit:
+            content = textwrap.shorten(text, width=limit, replace_whitespace=False, break_long_words=True,
+                                       placeholder="... <a href='#' class='read-more'>more</a>")
+    tokens = tokenize_content(content)
+    keys = get_mentioned_pubkeys(tokens)
+    if len(keys) == 0:
+        return content, keys
+    profiles = PROFILE_BRIEFS.get(DB, keys)
+
+    def replace(token):
+        if token.kind != 'mention' or token.value[1:] not in profiles:
+            return None
+        pk = token.value[1:]
+        name = '{}&#8230;{}'.format(pk[:3], pk[-5:])
+        profile = profiles[pk]
+        if profile is not None and profile['name'] is not None and len(profile['name']) > 0:
+            name = profile['name']
+        return "<a class='uname' href='/profile?pk={}'>@{}</a>".format(pk, name)
+
+    return replace_tokens(content, tokens, replace), keys
 
 
 @app.template_filter('get_thread_root')
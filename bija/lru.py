@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from threading import RLock
+
+
+# Thread safe LRU of at most size entries that counts hits and misses, shared by the in-memory caches.
+# discard() and clear() bump the revision. A value loaded before an invalidation is passed to put() with the
+# revision read before loading and isn't stored, so a read racing a commit can't bring stale data back.
+# on_remove(key, value) is called under the lock for every entry that is evicted or discarded.
+# The lock is reentrant, caches that keep their own indexes next to the entries hold it around them.
+class BoundedLRU:
+
+    def __init__(self, size, on_remove=None):
+        self.size = size
+        self.items = OrderedDict()
+        self.on_remove = on_remove
+        self.revision = 0
+        self.lock = RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    # (True, value) for a cached key, (False, None) otherwise
+    def get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return True, self.items[key]
+            self.misses += 1
+            return False, None
+
+    # stores {key: value}, unless revision is given and the cache was invalidated since it was read
+    # returns whether the values were stored
+    def put(self, items: dict, revision=None):
+        with self.lock:
+            if revision is not None and revision != self.revision:
+                return False
+            for key, value in items.items():
+                self.items[key] = value
+                self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.remove(next(iter(self.items)))
+            return True
+
+    def discard(self, keys):
+        with self.lock:
+            self.revision += 1
+            for key in list(keys):
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.revision += 1
+            self.items.clear()
+
+    def remove(self, key):
+        if key in self.items:
+            value = self.items.pop(key)
+            if self.on_remove is not None:
+                self.on_remove(key, value)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total > 0 else 0
+            }
@@ -0,0 +1,211 @@
+import json
+import logging
+import time
+
+from sqlalchemy import text
+
+from bija.args import LOGGING_LEVEL
+from bija.models import Base, SchemaMigration
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGGING_LEVEL)
+
+
+def create_missing_indexes(connection):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def has_column(connection, table, column):
+    rows = connection.execute(text("PRAGMA table_info('{}')".format(table))).all()
+    return column in [r.name for r in rows]
+
+
+def add_column(connection, table, column, definition):
+    if not has_column(connection, table, column):
+        connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition)))
+
+
+class Migration:
+    version = 0
+    description = ''
+    has_backfill = False
+    chunk_size = 5000
+
+    # schema changes, applied at startup in a single transaction
+    def upgrade(self, connection):
+        pass
+
+    # number of rows the backfill has to work through, used for progress reporting
+    def backfill_total(self, session):
+        return 0
+
+    # process up to limit rows after cursor and return (new cursor, rows processed)
+    # a cursor of None marks the backfill as finished
+    def backfill_chunk(self, session, cursor, limit):
+        return None, 0
+
+
+class AddSecondaryIndexes(Migration):
+    version = 1
+    description = 'secondary indexes'
+
+    def upgrade(self, connection):
+        create_missing_indexes(connection)
+
+
+class FeedKeysetIndex(Migration):
+    version = 2
+    description = 'note (created_at, id) index for keyset paging'
+
+    def upgrade(self, connection):
+        connection.execute(text("DROP INDEX IF EXISTS ix_note_created_at"))
+        create_missing_indexes(connection)
+
+
+class FillTimeline(Migration):
+    version = 3
+    description = 'fill the home timeline from followed accounts'
+    has_backfill = True
+    chunk_size = 20000
+
+    def backfill_total(self, session):
+        return session.execute(text("SELECT COALESCE(MAX(rowid), 0) FROM note")).scalar()
+
+    # works through note rowid ranges, the cursor is the last rowid handled
+    def backfill_chunk(self, session, cursor, limit):
+        start = int(cursor) if cursor is not None else 0
+        session.execute(text("""INSERT OR IGNORE INTO timeline (note_id, public_key, created_at)
+            SELECT note.id, note.public_key, note.created_at FROM note
+            JOIN profile ON profile.public_key = note.public_key
+            WHERE profile.following = 1 AND note.rowid > :start AND note.rowid <= :end"""), {
+            'start': start,
+            'end': start + limit
+        })
+        if start + limit >= self.backfill_total(session):
+            return None, limit
+        return str(start + limit), limit
+
+
+class FillContacts(Migration):
+    version = 4
+    description = 'move contact lists into the contact table'
+    has_backfill = True
+    chunk_size = 500
+
+    def backfill_total(self, session):
+        return session.execute(text("SELECT COALESCE(MAX(rowid), 0) FROM profile")).scalar()
+
+    # works through profile rowid ranges and clears each json list once copied,
+    # storing a new contact list clears it too so an older list can't be copied over it
+    def backfill_chunk(self, session, cursor, limit):
+        start = int(cursor) if cursor is not None else 0
+        rows = session.execute(text("""SELECT public_key, contacts FROM profile
+            WHERE contacts IS NOT NULL AND rowid > :start AND rowid <= :end"""), {
+            'start': start,
+            'end': start + limit
+        }).all()
+        edges = []
+        for row in rows:
+            try:
+                keys = json.loads(row.contacts)
+            except ValueError:
+                continue
+            if isinstance(keys, list):
+                keys = dict.fromkeys(k for k in keys if isinstance(k, str))
+                edges.extend({'public_key': row.public_key, 'contact': k, 'position': i} for i, k in enumerate(keys))
+        if len(edges) > 0:
+            session.execute(text("""INSERT OR IGNORE INTO contact (public_key, contact, position)
+                VALUES (:public_key, :contact, :position)"""), edges)
+        session.execute(text("UPDATE profile SET contacts = NULL WHERE rowid > :start AND rowid <= :end"), {
+            'start': start,
+            'end': start + limit
+        })
+        if start + limit >= self.backfill_total(session):
+            return None, limit
+        return str(start + limit), limit
+
+
+# lists copied before the position was kept have no order to recover, they stay unordered until the account
+# publishes its next contact list
+class ContactPosition(Migration):
+    version = 5
+    description = 'contact list order'
+
+    def upgrade(self, connection):
+        add_column(connection, 'contact', 'position', 'INTEGER')
+
+
+MIGRATIONS = [
+    AddSecondaryIndexes(),
+    FeedKeysetIndex(),
+    FillTimeline(),
+    FillContacts(),
+    ContactPosition(),
+]
+
+
+# Applies pending migrations when the database is opened.
+# Schema changes run straight away, backfills are worked through afterwards by the db writer one chunk per job
+# so that startup isn't held up and no other connection competes for the write lock.
+# A backfill resumes from its cursor after a restart.
+class Migrator:
+
+    def __init__(self, engine, session_factory, migrations):
+        self.engine = engine
+        self.session_factory = session_factory
+        self.migrations = sorted(migrations, key=lambda m: m.version)
+
+    def applied_versions(self):
+        session = self.session_factory()
+        try:
+            return {row.version: row.completed_at for row in session.query(SchemaMigration).all()}
+        finally:
+            session.close()
+
+    def current_version(self):
+        versions = self.applied_versions()
+        if len(versions) == 0:
+            return 0
+        return max(versions.keys())
+
+    def run(self):
+        applied = self.applied_versions()
+        for migration in self.migrations:
+            if migration.version not in applied:
+                self.apply(migration)
+
+    def apply(self, migration):
+        print('Applying database migration {}: {}'.format(migration.version, migration.description))
+        now = int(time.time())
+        with self.engine.begin() as connection:
+            migration.upgrade(connection)
+            connection.execute(SchemaMigration.__table__.insert().values(
+                version=migration.version,
+                description=migration.description,
+                applied_at=now,
+                completed_at=None if migration.has_backfill else now
+            ))
+
+    # process the next chunk of the first unfinished backfill in the caller's transaction
+    # returns False once there is nothing left to do
+    def backfill_step(self, session):
+        rows = session.query(SchemaMigration).filter(SchemaMigration.completed_at.is_(None)).all()
+        pending = {row.version: row for row in rows}
+        for migration in self.migrations:
+            row = pending.get(migration.version)
+            if row is None:
+                continue
+            if row.cursor is None:
+                total = migration.backfill_total(session)
+                logger.info('Backfilling migration {}: {} rows'.format(migration.version, total))
+            cursor, n = migration.backfill_chunk(session, row.cursor, migration.chunk_size)
+            row.cursor = cursor
+            if cursor is None:
+                row.completed_at = int(time.time())
+                logger.info('Migration {} complete'.format(migration.version))
+            else:
+                logger.info('Migration {} backfill at {}'.format(migration.version, cursor))
+            return True
+        return False
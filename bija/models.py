@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Index
 from sqlalchemy.orm import relationship, declarative_base
 
 Base = declarative_base()
@@ -12,6 +12,9 @@ class Event(Base):
 
 class Profile(Base):
     __tablename__ = "profile"
+    __table_args__ = (
+        Index('ix_profile_following', 'following'),
+    )
     public_key = Column(String(64), unique=True, primary_key=True)
     name = Column(String, nullable=True)
     nip05 = Column(String, nullable=True)
@@ -44,6 +47,13 @@ class Profile(Base):
 
 class Note(Base):
     __tablename__ = "note"
+    __table_args__ = (
+        Index('ix_note_public_key_created_at', 'public_key', 'created_at'),
+        Index('ix_note_created_at_id', 'created_at', 'id'),
+        Index('ix_note_thread_root', 'thread_root'),
+        Index('ix_note_response_to', 'response_to'),
+        Index('ix_note_seen_public_key', 'seen', 'public_key'),
+    )
     id = Column(String(64), unique=True, primary_key=True)
     public_key = Column(String(64), ForeignKey("profile.public_key"))
     content = Column(String)
@@ -82,6 +92,10 @@ class Note(Base):
 
 class PrivateMessage(Base):
     __tablename__ = "private_message"
+    __table_args__ = (
+        Index('ix_private_message_public_key_created_at', 'public_key', 'created_at'),
+        Index('ix_private_message_seen', 'seen'),
+    )
     id = Column(String(64), unique=True, primary_key=True)
     public_key = Column(String(64), ForeignKey("profile.public_key"))
     content = Column(String)
@@ -111,6 +125,9 @@ class Settings(Base):
 
 class NoteReaction(Base):
     __tablename__ = "note_reactions"
+    __table_args__ = (
+        Index('ix_note_reactions_event_id_public_key', 'event_id', 'public_key'),
+    )
     id = Column(String, primary_key=True)
     public_key = Column(String)
     event_id = Column(Integer)
@@ -138,6 +155,10 @@ class ReactionTally(Base):
 
 class Alert(Base):
     __tablename__ = "alerts"
+    __table_args__ = (
+        Index('ix_alerts_ts', 'ts'),
+        Index('ix_alerts_seen', 'seen'),
+    )
     id = Column(String(64), primary_key=True)  # the id of the new event
     kind = Column(Integer)
     event = Column(String(64))  # id of the event being referenced (commented on, liked...)
@@ -159,3 +180,49 @@ class Relay(Base):
     __tablename__ = "relay"
     id = Column(Integer, primary_key=True)
     name = Column(String, unique=True)
+
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migration"
+    version = Column(Integer, primary_key=True)
+    description = Column(String)
+    applied_at = Column(Integer)
+    completed_at = Column(Integer, nullable=True)  # null until the backfill has finished
+    cursor = Column(String, nullable=True)  # last key handled by the backfill
+
+
+# notes from followed accounts and from me, maintained at ingest so the home feed is a range scan
+class Timeline(Base):
+    __tablename__ = "timeline"
+    __table_args__ = (
+        Index('ix_timeline_created_at_note_id', 'created_at', 'note_id'),
+        Index('ix_timeline_public_key', 'public_key'),
+    )
+    note_id = Column(String(64), primary_key=True)
+    public_key = Column(String(64))
+    created_at = Column(Integer)
+
+
+# link previews keyed by normalized url, shared by every note linking to it
+class OGCache(Base):
+    __tablename__ = "og_cache"
+    url = Column(String, primary_key=True)
+    title = Column(String)
+    description = Column(String)
+    image = Column(String)
+    og_url = Column(String)
+    status = Column(Integer)
+    fetched_at = Column(Integer)
+    attempts = Column(Integer, default=0)
+
+
+# one row per key in a profile's contact list (kind 3), replaces the json list in profile.contacts
+class Contact(Base):
+    __tablename__ = "contact"
+    __table_args__ = (
+        Index('ix_contact_contact', 'contact'),
+    )
+    public_key = Column(String(64), primary_key=True)
+    contact = Column(String(64), primary_key=True)
+    # index in the contact list, lists are shown in the order they were published
+    position = Column(Integer)
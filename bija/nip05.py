@@ -0,0 +1,122 @@
+import logging
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from bija.args import LOGGING_LEVEL
+from bija.config import NIP05_WORKERS, NIP05_CACHE_SIZE, NIP05_CACHE_TTL, NIP05_NEGATIVE_TTL, NIP05_BATCH_DELAY
+from bija.db_writer import DB_WRITER
+from bija.helpers import is_nip05, request_nip05_names
+from bija.lru import BoundedLRU
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGGING_LEVEL)
+
+
+# Verifies nip-05 identifiers off the event loop.
+# Results are kept in an LRU per (name, domain), misses and failed requests are cached for a shorter time.
+# Identifiers queued for the same domain are checked together: when several are waiting the domain's
+# full nostr.json is requested once, and only names missing from it are asked for one by one.
+class Nip05Verifier:
+
+    def __init__(self, workers, size):
+        self.cache = BoundedLRU(size)
+        self.pending = {}
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='nip05')
+        self.fetches = 0
+
+    @staticmethod
+    def parse(nip05):
+        parts = is_nip05(nip05)
+        if not parts:
+            return None
+        return parts[0], parts[1].lower()
+
+    # the cached pubkey for an identifier: (True, pubkey or None) if known, (False, None) if not
+    def cached(self, key):
+        with self.cache.lock:
+            found, entry = self.cache.get(key)
+            if not found:
+                return False, None
+            if entry[1] <= time.time():
+                self.cache.discard([key])
+                return False, None
+            return True, entry[0]
+
+    def remember(self, names, domain, requested):
+        now = time.time()
+        entries = {(name, domain): (pk, now + NIP05_CACHE_TTL) for name, pk in names.items()}
+        for name in requested:
+            if name not in names:
+                entries[(name, domain)] = (None, now + NIP05_NEGATIVE_TTL)
+        self.cache.put(entries)
+
+    # True/False when the answer is cached, otherwise None and the check runs in the background,
+    # its result is written to the profile through the db writer
+    def verify(self, nip05, public_key):
+        key = self.parse(nip05)
+        if key is None:
+            return False
+        found, pk = self.cached(key)
+        if found:
+            return pk == public_key
+        name, domain = key
+        with self.lock:
+            waiting = self.pending.setdefault(domain, [])
+            waiting.append((name, nip05, public_key))
+            start = len(waiting) == 1
+        if start:
+            self.executor.submit(self.verify_domain, domain)
+        return None
+
+    def verify_domain(self, domain):
+        try:
+            time.sleep(NIP05_BATCH_DELAY)
+            with self.lock:
+                waiting = self.pending.pop(domain, [])
+            names = {w[0] for w in waiting}
+            if len(names) > 1:
+                self.fetch(domain, names)
+            for name in names:
+                if not self.cached((name, domain))[0]:
+                    self.fetch(domain, {name}, name)
+            for name, nip05, public_key in waiting:
+                found, pk = self.cached((name, domain))
+                DB_WRITER.submit('set_valid_nip05', public_key, nip05, found and pk == public_key)
+        except Exception:
+            logging.error(traceback.format_exc())
+
+    def fetch(self, domain, requested, name=None):
+        logger.info('fetch nip05 names for {}'.format(domain))
+        with self.lock:
+            self.fetches += 1
+        names = request_nip05_names(domain, name)
+        if names is None:
+            names = {}
+        # a full listing can't prove a name is missing, the per-name request decides that
+        if name is None:
+            requested = {n for n in requested if n in names}
+        self.remember(names, domain, requested)
+
+    # blocking lookup for pages that need the answer now
+    # a cached miss is asked again, the user may have just fixed their nostr.json
+    def resolve(self, nip05):
+        key = self.parse(nip05)
+        if key is None:
+            return None
+        found, pk = self.cached(key)
+        if not found or pk is None:
+            self.fetch(key[1], {key[0]}, key[0])
+            pk = self.cached(key)[1]
+        return pk
+
+    def stats(self):
+        stats = self.cache.stats()
+        with self.lock:
+            stats['fetches'] = self.fetches
+        return stats
+
+
+NIP05_VERIFIER = Nip05Verifier(NIP05_WORKERS, NIP05_CACHE_SIZE)
@@ -0,0 +1,70 @@
+import logging
+
+from bija.args import LOGGING_LEVEL
+from bija.config import NOTE_HTML_CACHE_SIZE
+from bija.lru import BoundedLRU
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGGING_LEVEL)
+
+
+# LRU of processed note fragments (content per truncation limit, media attachments) keyed by note id.
+# Note content doesn't change once stored, so entries are only dropped when the note is deleted,
+# its media is updated or a profile it mentions changes.
+# A fragment rendered across an invalidation is not stored (see BoundedLRU.put).
+# by_note and by_profile index the keys for those invalidations and are kept under the cache's lock.
+class NoteHtmlCache:
+
+    def __init__(self, size):
+        self.fragments = BoundedLRU(size, on_remove=self.unindex)
+        self.by_note = {}
+        self.by_profile = {}
+
+    @property
+    def revision(self):
+        return self.fragments.revision
+
+    def get(self, key):
+        found, entry = self.fragments.get(key)
+        return entry[0] if found else None
+
+    def put(self, key, html, revision, mentions=()):
+        with self.fragments.lock:
+            if self.fragments.put({key: (html, tuple(mentions))}, revision):
+                self.by_note.setdefault(key[0], set()).add(key)
+                for pk in mentions:
+                    self.by_profile.setdefault(pk, set()).add(key)
+
+    def discard_notes(self, note_ids):
+        with self.fragments.lock:
+            self.fragments.discard([key for note_id in note_ids for key in self.by_note.get(note_id, ())])
+
+    def discard_profiles(self, public_keys):
+        with self.fragments.lock:
+            self.fragments.discard([key for pk in public_keys for key in self.by_profile.get(pk, ())])
+
+    def clear(self):
+        with self.fragments.lock:
+            self.fragments.clear()
+            self.by_note.clear()
+            self.by_profile.clear()
+
+    # drops a fragment that left the cache from the note and profile indexes
+    def unindex(self, key, entry):
+        self.drop_index(self.by_note, key[0], key)
+        for pk in entry[1]:
+            self.drop_index(self.by_profile, pk, key)
+
+    @staticmethod
+    def drop_index(index, k, key):
+        keys = index.get(k)
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del index[k]
+
+    def stats(self):
+        return self.fragments.stats()
+
+
+NOTE_HTML = NoteHtmlCache(NOTE_HTML_CACHE_SIZE)
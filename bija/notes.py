@@ -4,12 +4,23 @@ import logging
 from bija.app import app
 from bija.args import LOGGING_LEVEL
 from bija.db import BijaDB
+from bija.helpers import tokenize_content, get_mentioned_pubkeys
+from bija.profile_briefs import PROFILE_BRIEFS
 
-DB = BijaDB(app.session)
+DB = BijaDB(app.read_session)
 logger = logging.getLogger(__name__)
 logger.setLevel(LOGGING_LEVEL)
 
 
+# pubkeys @mentioned in the content of a list of notes
+def get_mentioned_keys(notes):
+    keys = []
+    for note in notes:
+        if note is not None and type(note) != str and note['content'] is not None:
+            keys += get_mentioned_pubkeys(tokenize_content(note['content']))
+    return list(dict.fromkeys(keys))
+
+
 class FeedThread:
     def __init__(self, notes):
         logger.info('FEED THREAD')
@@ -18,8 +29,12 @@ class FeedThread:
         self.roots = []
         self.ids = set()
         self.last_ts = None
+        self.last_id = None
+        self.fetched = {}
 
         self.get_roots()
+        self.fetch_related()
+        self.prefetch_profiles()
         self.build()
 
     def get_roots(self):
@@ -28,6 +43,7 @@ class FeedThread:
         for note in self.notes:
             note = dict(note)
             self.last_ts = note['created_at']
+            self.last_id = note['id']
             if note['thread_root'] is not None:
                 roots.append(note['thread_root'])
                 self.add_id(note['thread_root'])
@@ -40,6 +56,21 @@ class FeedThread:
 
         self.roots = list(dict.fromkeys(roots))
 
+    # thread roots and reshared notes are loaded together in one query
+    def fetch_related(self):
+        logger.info('fetch related')
+        ids = set(self.roots)
+        ids.update(note['reshare'] for note in self.notes if note['reshare'] is not None)
+        for note in DB.get_notes(list(ids)):
+            self.fetched[note['id']] = note
+
+    # everyone mentioned on the page is loaded before rendering so the templates don't query per mention
+    def prefetch_profiles(self):
+        logger.info('prefetch profiles')
+        keys = get_mentioned_keys(list(self.notes) + list(self.fetched.values()))
+        if len(keys) > 0:
+            PROFILE_BRIEFS.prefetch(DB, keys)
+
     def add_id(self, note_id):
         logger.info('add id: {}'.format(note_id))
         if note_id not in self.ids:
@@ -47,53 +78,48 @@ class FeedThread:
 
     def build(self):
         logger.info('build')
+        grouped = self.group_by_root()
         for root in self.roots:
-            t = self.build_thread(root)
+            t = self.build_thread(root, grouped[root])
             self.threads.append(t)
 
-    def build_thread(self, root):
-        logger.info('build thread')
-        t = {'self': None, 'id': root, 'response': None, 'responders': {}}
-        responders = []
+    # each note goes to the earliest root it belongs to, in a single pass over the page
+    def group_by_root(self):
+        logger.info('group by root')
+        order = {root: i for i, root in enumerate(self.roots)}
+        grouped = {root: [] for root in self.roots}
         for _note in self.notes:
             note = dict(_note)
+            candidates = [k for k in (note['id'], note['response_to'], note['thread_root']) if k in order]
+            if len(candidates) > 0:
+                grouped[min(candidates, key=order.get)].append(note)
+        return grouped
 
-            is_root, is_response = self.is_in_thread(note, root)
-            if is_root:
-                self.notes.remove(_note)
+    def build_thread(self, root, notes):
+        logger.info('build thread')
+        t = {'self': None, 'id': root, 'response': None, 'responders': {}}
+        responders = set()
+        for note in notes:
+            if note['id'] == root:
                 t['self'] = note
-            elif is_response:
-                self.notes.remove(_note)
+            else:
                 if t['response'] is None:
                     t['response'] = note
                 if len(t['responders']) < 2:
                     t['responders'][note['public_key']] = note['name']
-                responders.append(note['public_key'])
+                responders.add(note['public_key'])
 
-            if (is_root or is_response) and note['reshare'] is not None:
-                reshare = DB.get_note(note['reshare'])
+            if note['reshare'] is not None:
+                reshare = self.fetched.get(note['reshare'])
                 self.add_id(note['reshare'])
                 if reshare is not None:
                     note['reshare'] = reshare
 
-        responders = list(dict.fromkeys(responders))
         t['responder_count'] = len(responders)
-
         if t['self'] is None:
-            t['self'] = DB.get_note(root)
+            t['self'] = self.fetched.get(root)
         return t
 
-    @staticmethod
-    def is_in_thread(note, root):
-        logger.info('is in thread?')
-        is_root = False
-        is_response = False
-        if note['id'] == root:
-            is_root = True
-        elif note['response_to'] == root or note['thread_root'] == root:
-            is_response = True
-        return is_root, is_response
-
 
 class NoteThread:
     def __init__(self, note_id):
@@ -107,10 +133,14 @@ class NoteThread:
         self.children = []
         self.note_ids = [self.id]
         self.public_keys = []
+        self.seen_keys = set()
         self.profiles = []
         self.determine_root()
-        self.notes = self.get_notes()
+        self.notes = {}
+        self.replies = {}
+        self.get_notes()
         self.process()
+        self.get_reshares()
         self.get_profile_briefs()
         self.result_set = self.root+self.ancestors+[self.note]+self.children
 
@@ -122,7 +152,7 @@ class NoteThread:
             self.get_root()
 
         if self.note is not None and type(self.note) == dict and self.note['response_to'] is not None:
-            self.get_ancestor(self.note['response_to'])
+            self.get_ancestors(self.note['response_to'])
 
         if len(self.children) > 0 and type(self.note) == dict:
             self.note['class'] = self.note['class'] + ' ancestor'
@@ -145,70 +175,60 @@ class NoteThread:
             return n
         return self.id
 
+    # index the thread once by id and by the note each reply answers
     def get_notes(self):
         logger.info('get notes')
-        return DB.get_note_thread(self.root_id)
+        for note in DB.get_note_thread(self.root_id):
+            n = dict(note)
+            self.notes[n['id']] = n
+            parent = n['response_to'] if n['response_to'] is not None else n['thread_root']
+            if parent is not None:
+                self.replies.setdefault(parent, []).append(n)
 
     def get_children(self):
         logger.info('get children')
-        to_remove = []
-        for note in self.notes:
-            n = dict(note)
-            if n['response_to'] == self.id or (n['thread_root'] == self.id and n['response_to'] is None):
-                self.children.append(n)
-                self.add_members(n)
-                to_remove.append(note)
-                n['reshare'] = self.get_reshare(n)
-                n['class'] = 'reply'
-                self.note_ids.append(n['id'])
-        self.remove_notes_from_list(to_remove)
-
-    def remove_notes_from_list(self, notes: list):
-        logger.info('remove used notes')
-        for n in notes:
-            self.notes.remove(n)
-
-    def get_ancestor(self, note_id):
-        logger.info('get ancestor')
-        to_remove = []
-        found = False
-        for note in self.notes:
-            n = dict(note)
-            if n['id'] == note_id:
-                self.ancestors.append(n)
-                self.add_members(n)
-                to_remove.append(note)
-                self.note_ids.insert(0, n['id'])
-                n['reshare'] = self.get_reshare(n)
-                n['class'] = 'ancestor'
-                if n['response_to'] is not None:
-                    self.get_ancestor(n['response_to'])
-                found = True
+        for n in self.replies.get(self.id, []):
+            self.children.append(n)
+            self.add_members(n)
+            n['class'] = 'reply'
+            self.note_ids.append(n['id'])
+
+    # walks up the reply chain, one lookup per hop
+    def get_ancestors(self, note_id):
+        logger.info('get ancestors')
+        visited = {self.id}
+        while note_id is not None and note_id not in visited:
+            visited.add(note_id)
+            if note_id == self.root_id and len(self.root) > 0:
+                break
+            n = self.notes.get(note_id)
+            if n is None:
+                self.ancestors.append(note_id)
                 break
-        if not found:
-            self.ancestors.append(note_id)
-        self.remove_notes_from_list(to_remove)
+            self.ancestors.append(n)
+            self.add_members(n)
+            self.note_ids.insert(0, n['id'])
+            n['class'] = 'ancestor'
+            note_id = n['response_to']
 
     def get_root(self):
         logger.info('get root')
-        for note in self.notes:
-            n = dict(note)
-            if n['id'] == self.root_id:
-                self.root = [n]
-                self.add_members(n)
-                self.notes.remove(note)
-                self.note_ids.append(n['id'])
-                n['class'] = 'root'
-                n['reshare'] = self.get_reshare(n)
-                break
-
-    def get_reshare(self, note):
-        logger.info('get reshare')
-        if note['reshare'] is not None:
-            reshare = DB.get_note(note['reshare'])
-            if reshare is not None:
-                return reshare
-        return None
+        n = self.notes.get(self.root_id)
+        if n is not None:
+            self.root = [n]
+            self.add_members(n)
+            self.note_ids.append(n['id'])
+            n['class'] = 'root'
+
+    # reshared notes for everything shown are loaded in one query
+    def get_reshares(self):
+        logger.info('get reshares')
+        shown = [n for n in self.root + self.ancestors + self.children if type(n) == dict]
+        ids = {n['reshare'] for n in shown if n['reshare'] is not None}
+        reshares = {r['id']: r for r in DB.get_notes(list(ids))}
+        for n in shown:
+            if n['reshare'] is not None:
+                n['reshare'] = reshares.get(n['reshare'])
 
     def determine_root(self):
         logger.info('determine root')
@@ -219,12 +239,16 @@ class NoteThread:
     def add_public_keys(self, public_keys: list):
         logger.info('add pub keys')
         for k in public_keys:
-            if k not in self.public_keys:
+            if k not in self.seen_keys:
+                self.seen_keys.add(k)
                 self.public_keys.append(k)
 
     def get_profile_briefs(self):
         logger.info('get profile briefs')
-        self.profiles = DB.get_profile_briefs(self.public_keys)
+        notes = list(self.notes.values()) + [self.note]
+        notes += [n['reshare'] for n in self.notes.values() if type(n['reshare']) != str]
+        briefs = PROFILE_BRIEFS.get(DB, self.public_keys + get_mentioned_keys(notes))
+        self.profiles = [briefs[k] for k in self.public_keys if briefs[k] is not None]
 
     def add_members(self, note):
         logger.info('add members')
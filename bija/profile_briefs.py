@@ -0,0 +1,69 @@
+import logging
+
+from flask import g, has_app_context
+
+from bija.args import LOGGING_LEVEL
+from bija.config import PROFILE_BRIEFS_SIZE
+from bija.lru import BoundedLRU
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGGING_LEVEL)
+
+
+# Process wide LRU of profile briefs (name, pic, nip05) used while rendering notes.
+# Each request keeps its own copy in flask.g so a page sees consistent names and repeated lookups are free.
+# Entries are dropped by the db layer once a profile update has been committed.
+# Briefs loaded across a drop are returned but not stored (see BoundedLRU.put).
+class ProfileBriefs:
+
+    def __init__(self, size):
+        self.briefs = BoundedLRU(size)
+
+    # returns {public_key: brief or None} for every requested key, loading anything unknown in one query
+    def get(self, db, public_keys):
+        local = self.request_cache()
+        out = {}
+        missing = []
+        with self.briefs.lock:
+            for k in dict.fromkeys(public_keys):
+                if k in local:
+                    out[k] = local[k]
+                    continue
+                found, brief = self.briefs.get(k)
+                if found:
+                    out[k] = brief
+                else:
+                    missing.append(k)
+            revision = self.briefs.revision
+        if len(missing) > 0:
+            logger.info('load {} profile briefs'.format(len(missing)))
+            loaded = {p['public_key']: p for p in db.get_profile_briefs(missing)}
+            for k in missing:
+                out[k] = loaded.get(k)
+            # a profile may have changed while loading, the rows could be older than the commit that dropped it
+            self.briefs.put({k: out[k] for k in missing}, revision)
+        local.update(out)
+        return out
+
+    def prefetch(self, db, public_keys):
+        self.get(db, public_keys)
+
+    def discard(self, public_keys):
+        self.briefs.discard(public_keys)
+
+    def clear(self):
+        self.briefs.clear()
+
+    @staticmethod
+    def request_cache():
+        if has_app_context():
+            if 'profile_briefs' not in g:
+                g.profile_briefs = {}
+            return g.profile_briefs
+        return {}
+
+    def stats(self):
+        return self.briefs.stats()
+
+
+PROFILE_BRIEFS = ProfileBriefs(PROFILE_BRIEFS_SIZE)
@@ -0,0 +1,53 @@
+import logging
+from typing import NamedTuple, Optional
+
+from bija.args import LOGGING_LEVEL
+from bija.config import PROFILE_VERSIONS_SIZE
+from bija.lru import BoundedLRU
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGGING_LEVEL)
+
+
+class ProfileVersion(NamedTuple):
+    updated_at: Optional[int]
+    nip05: Optional[str]
+    nip05_validated: bool
+
+
+NO_PROFILE = ProfileVersion(None, None, False)
+
+
+# LRU of the stored metadata timestamp (plus nip05 state) per pubkey, written only after a commit.
+# Lets kind-0 events that are older than, or the same as, what we already have be dropped without a query.
+class ProfileVersions:
+
+    def __init__(self, size):
+        self.versions = BoundedLRU(size)
+
+    def get(self, public_key):
+        return self.versions.get(public_key)[1]
+
+    def missing(self, public_keys):
+        with self.versions.lock:
+            return [k for k in dict.fromkeys(public_keys) if k not in self.versions]
+
+    # True only when the stored metadata is known to be at least as new as created_at
+    def is_stale(self, public_key, created_at):
+        v = self.get(public_key)
+        return v is not None and v.updated_at is not None and v.updated_at >= created_at
+
+    def put(self, versions: dict):
+        self.versions.put(versions)
+
+    def discard(self, public_keys):
+        self.versions.discard(public_keys)
+
+    def clear(self):
+        self.versions.clear()
+
+    def stats(self):
+        return self.versions.stats()
+
+
+PROFILE_VERSIONS = ProfileVersions(PROFILE_VERSIONS_SIZE)
@@ -10,7 +10,8 @@ from flask_executor import Executor
 
 from bija.app import app, socketio
 from bija.args import SETUP_PK, SETUP_PW, LOGGING_LEVEL
-from bija.config import DEFAULT_RELAYS
+from bija.config import DEFAULT_RELAYS, INGEST_BATCH_SIZE, INGEST_FLUSH_MS
+from bija.db_writer import DB_WRITER
 from bija.emojis import emojis
 from bija.events import BijaEvents, MetadataEvent
 from bija.helpers import *
@@ -25,7 +26,7 @@ logger.setLevel(LOGGING_LEVEL)
 
 thread = Thread()
 
-DB = BijaDB(app.session)
+DB = BijaDB(app.read_session)
 EXECUTOR = Executor(app)
 EVENT_HANDLER = BijaEvents()
 
@@ -65,28 +66,26 @@ def login_required(f):
 def index_page():
     EXECUTOR.submit(EVENT_HANDLER.set_page('home', None))
     EXECUTOR.submit(EVENT_HANDLER.close_secondary_subscriptions)
-    DB.set_all_seen_in_feed(get_key())
-    notes = DB.get_feed(time.time(), get_key())
+    DB_WRITER.submit('set_all_seen_in_feed')
+    notes = DB.get_feed(time.time())
     t = FeedThread(notes)
     EXECUTOR.submit(EVENT_HANDLER.subscribe_feed(list(t.ids)))
     profile = DB.get_profile(get_key())
     return render_template("feed.html", page_id="home", title="Home", threads=t.threads, last=t.last_ts,
-                           profile=profile)
+                           last_id=t.last_id, profile=profile)
 
 
 @app.route('/feed', methods=['GET'])
 def feed():
     if request.method == 'GET':
-        if 'before' in request.args:
-            before = int(request.args['before'])
-        else:
-            before = time.time()
-        notes = DB.get_feed(before, get_key())
+        before, before_id = get_page_cursor()
+        notes = DB.get_feed(before, before_id)
         if len(notes) > 0:
             t = FeedThread(notes)
             EXECUTOR.submit(EVENT_HANDLER.subscribe_feed(list(t.ids)))
             profile = DB.get_profile(get_key())
-            return render_template("feed.items.html", threads=t.threads, last=t.last_ts, profile=profile)
+            return render_template("feed.items.html", threads=t.threads, last=t.last_ts, last_id=t.last_id,
+                                   profile=profile)
         else:
             return 'END'
 
@@ -95,7 +94,7 @@ def feed():
 @login_required
 def alerts_page():
     alerts = DB.get_alerts()
-    DB.set_alerts_read()
+    DB_WRITER.submit('set_alerts_read')
     return render_template("alerts.html", page_id="alerts", title="alerts", alerts=alerts)
 
 
@@ -158,7 +157,7 @@ def profile_page():
     if latest is None:
         latest = 0
     if profile is None:
-        DB.add_profile(k)
+        DB_WRITER.call('add_profile', k)
         profile = DB.get_profile(k)
 
     EXECUTOR.submit(EVENT_HANDLER.subscribe_profile, k, timestamp_minus(TimePeriod.WEEK), list(t.ids))
@@ -172,25 +171,23 @@ def profile_page():
                 metadata[item] = meta[item]
 
     return render_template("profile.html", page_id=page_id, title="Profile", threads=t.threads, last=t.last_ts,
-                           latest=latest, profile=profile, is_me=is_me, meta=metadata)
+                           last_id=t.last_id, latest=latest, profile=profile, is_me=is_me, meta=metadata)
 
 
 
 @app.route('/profile_feed', methods=['GET'])
 def profile_feed():
     if request.method == 'GET':
-        if 'before' in request.args:
-            before = int(request.args['before'])
-        else:
-            before = time.time()
-        notes = DB.get_notes_by_pubkey(request.args['pk'], before, None)
+        before, before_id = get_page_cursor()
+        notes = DB.get_notes_by_pubkey(request.args['pk'], before, None, before_id)
         if len(notes) > 0:
             t = FeedThread(notes)
             profile = DB.get_profile(get_key())
             EXECUTOR.submit(
                 EVENT_HANDLER.subscribe_profile, request.args['pk'], t.last_ts - TimePeriod.WEEK, list(t.ids)
             )
-            return render_template("feed.items.html", threads=t.threads, last=t.last_ts, profile=profile)
+            return render_template("feed.items.html", threads=t.threads, last=t.last_ts, last_id=t.last_id,
+                                   profile=profile)
         else:
             return 'END'
 
@@ -289,7 +286,7 @@ def settings_page():
     if request.method == 'POST' and 'del_keys' in request.form.keys():
         print("RESET DB")
         EVENT_HANDLER.close()
-        DB.reset()
+        DB_WRITER.call('reset')
         return redirect('/')
     else:
         EXECUTOR.submit(EVENT_HANDLER.set_page('settings', None))
@@ -300,7 +297,9 @@ def settings_page():
             'pow_default': '',
             'pow_default_enc': '',
             'pow_required': '',
-            'pow_required_enc': ''
+            'pow_required_enc': '',
+            'ingest_batch_size': INGEST_BATCH_SIZE,
+            'ingest_flush_ms': INGEST_FLUSH_MS
         }
         cs = DB.get_settings_by_keys([
             'cloudinary_cloud',
@@ -308,7 +307,9 @@ def settings_page():
             'pow_default',
             'pow_default_enc',
             'pow_required',
-            'pow_required_enc'])
+            'pow_required_enc',
+            'ingest_batch_size',
+            'ingest_flush_ms'])
         if cs is not None:
             for item in cs:
                 item = dict(item)
@@ -339,7 +340,7 @@ def update_settings():
     items = {}
     for item in request.json:
         items[item[0]] = item[1].strip()
-    DB.upd_settings_by_keys(items)
+    DB_WRITER.call('upd_settings_by_keys', items)
     Settings.set_from_db()
     return render_template("upd.json", data=json.dumps({'success': 1}))
 
@@ -347,7 +348,7 @@ def update_settings():
 @app.route('/destroy_account')
 def destroy_account():
     EVENT_HANDLER.close()
-    DB.reset()
+    DB_WRITER.call('reset')
     if os.path.exists("bija.sqlite"):
         os.remove("bija.sqlite")
     return render_template("restart.html")
@@ -380,7 +381,7 @@ def add_relay():
             ws = item[1].strip()
             if item[0] == 'newrelay' and is_valid_relay(ws):
                 success = True
-                DB.insert_relay(ws)
+                DB_WRITER.submit('insert_relay', ws)
                 EXECUTOR.submit(EVENT_HANDLER.add_relay(ws))
     return render_template("upd.json", data=json.dumps({'add_relay': success}))
 
@@ -408,6 +409,7 @@ def private_message_page():
     messages = []
     pk = ''
     if 'pk' in request.args and is_hex_key(request.args['pk']):
+        DB_WRITER.submit('set_message_thread_read', request.args['pk'])
         messages = DB.get_message_thread(request.args['pk'])
         pk = request.args['pk']
 
@@ -436,10 +438,10 @@ def submit_like():
         note_id = request.args['id']
         note = DB.get_note(note_id)
         if note.liked is False:
-            DB.set_note_liked(note_id)
+            DB_WRITER.submit('set_note_liked', note_id)
             event_id = EVENT_HANDLER.submit_like(note_id)
         else:
-            DB.set_note_liked(note_id, False)
+            DB_WRITER.submit('set_note_liked', note_id, False)
             like_events = DB.get_like_events_for(note_id, get_key())
             if like_events is not None:
                 ids = []
@@ -458,13 +460,7 @@ def following_page():
         EXECUTOR.submit(EVENT_HANDLER.subscribe_profile, request.args['pk'], timestamp_minus(TimePeriod.WEEK), [])
         k = request.args['pk']
         is_me = False
-        p = DB.get_profile(k)
-        profiles = []
-        if p is not None and p.contacts is not None:
-            for key in json.loads(p.contacts):
-                profile = DB.get_profile(key)
-                if profile is not None:
-                    profiles.append(profile)
+        profiles = DB.get_contact_profiles(k)
     else:
         k = get_key()
         is_me = True
@@ -558,7 +554,7 @@ def io_connect(m):
     if unseen_messages > 0:
         socketio.emit('unseen_messages_n', unseen_messages)
 
-    unseen_posts = DB.get_unseen_in_feed()
+    unseen_posts = DB.get_unseen_in_feed(get_key())
     if unseen_posts > 0:
         socketio.emit('unseen_posts_n', unseen_posts)
 
@@ -576,14 +572,14 @@ def refresh_connections():
 
 @app.route('/del_relay', methods=['GET'])
 def del_relay():
-    DB.remove_relay(request.args['url'])
+    DB_WRITER.submit('remove_relay', request.args['url'])
     EXECUTOR.submit(EVENT_HANDLER.remove_relay(request.args['url']))
     return render_template("upd.json", data=json.dumps({'del': True}))
 
 
 @app.route('/follow', methods=['GET'])
 def follow():
-    DB.set_following([request.args['id']], int(request.args['state']))
+    DB_WRITER.call('set_following', [request.args['id']], int(request.args['state']))
     EXECUTOR.submit(EVENT_HANDLER.submit_follow_list)
     profile = DB.get_profile(request.args['id'])
     is_me = request.args['id'] == get_key()
@@ -652,6 +648,7 @@ def submit_note():
 @app.teardown_appcontext
 def remove_session(*args, **kwargs):
     app.session.remove()
+    app.read_session.remove()
 
 
 @app.get('/shutdown')
@@ -664,7 +661,7 @@ def get_login_state():
     logger.info('Getting login state')
     if SETUP_PK is not None and Settings.get("keys") is None:
         logger.info('New setup detected')
-        DB.save_pk(encrypt_key(SETUP_PW, SETUP_PK), 1)
+        DB_WRITER.call('save_pk', encrypt_key(SETUP_PW, SETUP_PK), 1)
         redirect('/login')
     if Settings.get("keys") is not None:
         logger.info('Has session keys, is logged in {}'.format(get_key()))
@@ -717,7 +714,7 @@ def process_login():
     elif 'add_relays' in request.form.keys():
         added = False
         for item in request.form.getlist('relay'):
-            DB.insert_relay(item)
+            DB_WRITER.call('insert_relay', item)
             added = True
         EVENT_HANDLER.open_connections()
         time.sleep(1)
@@ -731,7 +728,19 @@ def process_key_save(pk):
         if len(pw) > 0:
             pk = encrypt_key(pw, pk)
             enc = 1
-        DB.save_pk(pk, enc)
+        DB_WRITER.call('save_pk', pk, enc)
+
+
+# the (created_at, id) of the last note on the previous page
+def get_page_cursor():
+    if 'before' in request.args:
+        before = int(request.args['before'])
+    else:
+        before = time.time()
+    before_id = None
+    if 'before_id' in request.args and is_hex_key(request.args['before_id']):
+        before_id = request.args['before_id']
+    return before, before_id
 
 
 def get_key(k='public'):
@@ -757,7 +766,8 @@ def set_session_keys(k):
     })
     process_key_save(private_key)
     if DB.get_profile(public_key) is None:
-        DB.add_profile(public_key)
+        DB_WRITER.call('add_profile', public_key)
+    DB_WRITER.submit('add_authors_to_timeline', [public_key])
 
 
 def shutdown_server():
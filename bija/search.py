@@ -5,9 +5,10 @@ from flask import request
 from bija.app import app
 from bija.args import LOGGING_LEVEL
 from bija.db import BijaDB
-from bija.helpers import is_hex_key, is_bech32_key, is_nip05, bech32_to_hex64, request_nip05
+from bija.helpers import is_hex_key, is_bech32_key, is_nip05, bech32_to_hex64
+from bija.nip05 import NIP05_VERIFIER
 
-DB = BijaDB(app.session)
+DB = BijaDB(app.read_session)
 logger = logging.getLogger(__name__)
 logger.setLevel(LOGGING_LEVEL)
 
@@ -66,7 +67,7 @@ class Search:
         if profile is not None:
             self.redirect = '/profile?pk={}'.format(profile.public_key)
         else:
-            pk = request_nip05(self.term)
+            pk = NIP05_VERIFIER.resolve(self.term)
             if pk is not None:
                 self.redirect = '/profile?pk={}'.format(pk)
             else:
@@ -0,0 +1,31 @@
+import logging
+
+from bija.args import LOGGING_LEVEL
+from bija.lru import BoundedLRU
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGGING_LEVEL)
+
+
+# Bounded LRU set of event ids that have already been processed.
+# Sits in front of DB.get_event so that events repeated by several relays are rejected without a query.
+class SeenEvents:
+
+    def __init__(self, size):
+        self.ids = BoundedLRU(size)
+
+    def warm(self, event_ids):
+        logger.info('warm seen events filter')
+        self.ids.put(dict.fromkeys(event_ids))
+
+    def seen(self, event_id):
+        return self.ids.get(event_id)[0]
+
+    def add(self, event_id):
+        self.ids.put({event_id: None})
+
+    def discard(self, event_id):
+        self.ids.discard([event_id])
+
+    def stats(self):
+        return self.ids.stats()
@@ -1,7 +1,7 @@
 from bija.app import app
 from bija.db import BijaDB
 
-DB = BijaDB(app.session)
+DB = BijaDB(app.read_session)
 
 
 class BijaSettings:
@@ -21,6 +21,12 @@ class BijaSettings:
             return self.items[k]
         return None
 
+    def get_int(self, k, default=None):
+        try:
+            return int(self.items[k])
+        except (KeyError, TypeError, ValueError):
+            return default
+
 
 Settings = BijaSettings()
 Settings.set_from_db()
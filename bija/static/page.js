@@ -436,6 +436,18 @@ class bijaSettings{
             fetchFromForm('/update_settings', pow_form, pow_cb, {}, 'json')
         });
 
+        const ingest_btn = document.querySelector("#upd_ingest");
+        ingest_btn.addEventListener("click", (event)=>{
+            event.preventDefault();
+            event.stopPropagation();
+            const ingest_form = document.querySelector("#ingest_cfg")
+
+            const ingest_cb = function(response, data){
+                notify('updated')
+            }
+            fetchFromForm('/update_settings', ingest_form, ingest_cb, {}, 'json')
+        });
+
     }
 
     setDeleteKeysClicked(){
@@ -964,7 +976,7 @@ class bijaFeed{
     loader(o){
         if ((window.innerHeight + window.innerHeight + window.scrollY) >= document.body.offsetHeight && o.loading == 0){
             let nodes = document.querySelectorAll('.ts[data-ts]')
-            o.requestNextPage(nodes[nodes.length-1].dataset.ts);
+            o.requestNextPage(nodes[nodes.length-1].dataset.ts, nodes[nodes.length-1].dataset.id);
         }
     }
 
@@ -972,7 +984,7 @@ class bijaFeed{
         this.loading = 2; // nothing more to load
     }
 
-    requestNextPage(ts){
+    requestNextPage(ts, id){
         this.loading = 1;
         const cb = function(response, data){
             if(response == 'END'){
@@ -984,11 +996,11 @@ class bijaFeed{
             }
         }
         if(this.page == 'home'){
-            fetchGet('/feed?before='+ts, cb, {'context': this})
+            fetchGet('/feed?before='+ts+'&before_id='+id, cb, {'context': this})
         }
         else{
             const profile_elem = document.querySelector("#profile")
-            fetchGet('/profile_feed?before='+ts+'&pk='+profile_elem.dataset.pk, cb, {'context': this})
+            fetchGet('/profile_feed?before='+ts+'&before_id='+id+'&pk='+profile_elem.dataset.pk, cb, {'context': this})
         }
     }
 
@@ -5,13 +5,14 @@ import time
 from bija.app import app
 from bija.args import LOGGING_LEVEL
 from bija.db import BijaDB
+from bija.db_writer import DB_WRITER
 from bija.helpers import is_hex_key, get_at_tags, get_hash_tags
 from python_nostr.nostr.event import EventKind, Event
 from python_nostr.nostr.key import PrivateKey
 from python_nostr.nostr.message_type import ClientMessageType
 from python_nostr.nostr.pow import mine_event
 
-DB = BijaDB(app.session)
+DB = BijaDB(app.read_session)
 logger = logging.getLogger(__name__)
 logger.setLevel(LOGGING_LEVEL)
 
@@ -168,7 +169,8 @@ class SubmitNote(Submit):
 
     def store(self):
         logger.info('insert note')
-        DB.insert_note(
+        DB_WRITER.call(
+            'insert_own_note',
             self.event_id,
             self.keys['public'],
             self.content,
@@ -95,15 +95,15 @@ class SubscribeProfile(Subscribe):
 
     def build_filters(self):
         logger.info('build subscription filters')
-        profile = DB.get_profile(self.pubkey)
+        contacts = DB.get_contacts(self.pubkey)
 
         f = [
             Filter(authors=[self.pubkey], kinds=[EventKind.SET_METADATA, EventKind.CONTACTS]),
             Filter(authors=[self.pubkey], kinds=[EventKind.TEXT_NOTE, EventKind.DELETE, EventKind.REACTION],
                    since=self.since)
         ]
-        if profile is not None and profile.contacts is not None:
-            contacts_filter = Filter(authors=json.loads(profile.contacts), kinds=[EventKind.SET_METADATA])
+        if len(contacts) > 0:
+            contacts_filter = Filter(authors=contacts, kinds=[EventKind.SET_METADATA])
             f.append(contacts_filter)
 
         self. filters = Filters(f)
@@ -119,8 +119,6 @@ class SubscribeThread(Subscribe):
     def build_filters(self):
         logger.info('build subscription filters')
         ids = DB.get_note_thread_ids(self.root)
-        if ids is None:
-            ids = [self.root]
 
         self.filters = Filters([
             Filter(tags={'#e': ids}, kinds=[EventKind.TEXT_NOTE, EventKind.REACTION]),  # event responses
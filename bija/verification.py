@@ -0,0 +1,77 @@
+import hashlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import secp256k1
+
+from bija.args import LOGGING_LEVEL
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGGING_LEVEL)
+
+# batches smaller than this are verified on the calling thread
+MIN_PARALLEL_BATCH = 8
+
+
+def compute_event_id(event):
+    data = [0, event.public_key, event.created_at, event.kind, event.tags, event.content]
+    serialized = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def verify_event(event):
+    try:
+        if compute_event_id(event) != event.id:
+            return False
+        pk = secp256k1.PublicKey(bytes.fromhex("02" + event.public_key), True)
+        return pk.schnorr_verify(bytes.fromhex(event.id), bytes.fromhex(event.signature), None, raw=True)
+    except (ValueError, TypeError, AttributeError):
+        return False
+
+
+def verify_events(events):
+    return [verify_event(event) for event in events]
+
+
+# Checks ids and signatures of incoming events before they are handed to the event handlers.
+# The secp256k1 calls release the GIL so the work is spread over a small thread pool.
+class EventVerifier:
+
+    def __init__(self, workers):
+        logger.info('EVENT VERIFIER')
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='verify')
+        self.lock = Lock()
+        self.valid = 0
+        self.invalid = 0
+
+    # returns the messages whose events passed verification, in their original order
+    def verify(self, batch):
+        events = [msg.event for msg in batch]
+        if len(events) < MIN_PARALLEL_BATCH or self.workers < 2:
+            results = verify_events(events)
+        else:
+            size = -(-len(events) // self.workers)
+            chunks = [events[i:i + size] for i in range(0, len(events), size)]
+            results = []
+            for chunk_results in self.pool.map(verify_events, chunks):
+                results.extend(chunk_results)
+
+        out = []
+        for msg, passed in zip(batch, results):
+            if passed:
+                out.append(msg)
+            else:
+                logger.info('Dropped invalid event {}'.format(msg.event.id))
+        with self.lock:
+            self.valid += len(out)
+            self.invalid += len(batch) - len(out)
+        return out
+
+    def stats(self):
+        return {
+            'valid': self.valid,
+            'invalid': self.invalid
+        }
@@ -0,0 +1,96 @@
+# Event ingest throughput.
+# Stores batches of notes, profile updates and reactions through the db writer the way the event loop does
+# and prints events per second. With beautifulsoup4 installed the run is repeated with the BeautifulSoup
+# based strip_tags that the html.parser extractor replaced.
+#
+#   python tests/bench_ingest.py [events]
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import warnings
+
+EVENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+# bija.args parses the command line when it's imported, run against a throwaway database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.argv = [sys.argv[0], '--db', os.path.join(tempfile.mkdtemp(prefix='bija-bench-'), 'bija')]
+
+import bija.app
+import bija.events as events
+from bija.config import INGEST_BATCH_SIZE
+from bija.db_writer import DB_WRITER
+from bija.routes import EVENT_HANDLER
+from python_nostr.nostr.event import Event, EventKind
+from python_nostr.nostr.message_pool import EventMessage
+
+with open(os.path.join(os.path.dirname(__file__), 'data', 'strip_tags.json'), encoding='utf-8') as f:
+    CONTENTS = [s['content'] for s in json.load(f)]
+
+AUTHORS = ['{:064x}'.format(0xb000 + i) for i in range(500)]
+
+
+# three notes for every profile update and reaction, roughly what a home feed subscription delivers
+def make_events(n, created_at, seed):
+    rng = random.Random(seed)
+    out = []
+    notes = []
+    for i in range(n):
+        author = rng.choice(AUTHORS)
+        kind = rng.choice([EventKind.TEXT_NOTE] * 3 + [EventKind.SET_METADATA, EventKind.REACTION])
+        if kind == EventKind.SET_METADATA:
+            content = json.dumps({'name': rng.choice(CONTENTS)[:40], 'about': rng.choice(CONTENTS)})
+            tags = []
+        elif kind == EventKind.REACTION and len(notes) > 0:
+            target = rng.choice(notes)
+            content = rng.choice(['+', '🤙', rng.choice(CONTENTS)[:20]])
+            tags = [['e', target.id], ['p', target.public_key]]
+        else:
+            kind = EventKind.TEXT_NOTE
+            content = rng.choice(CONTENTS)
+            tags = [['p', rng.choice(AUTHORS)]]
+        event = Event(author, content, created_at + i, kind, tags)
+        if kind == EventKind.TEXT_NOTE:
+            notes.append(event)
+        out.append(EventMessage(event, 'primary', 'wss://bench'))
+    return out
+
+
+def bs4_strip_tags(content):
+    from bs4 import BeautifulSoup
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return BeautifulSoup(content, features="html.parser").get_text()
+
+
+def run(label, created_at, seed):
+    batch = make_events(EVENTS, created_at, seed)
+    started = time.perf_counter()
+    for i in range(0, len(batch), INGEST_BATCH_SIZE):
+        DB_WRITER.call(EVENT_HANDLER.process_events, batch[i:i + INGEST_BATCH_SIZE], exclusive=True)
+    elapsed = time.perf_counter() - started
+    print('{}: {} events in {:.2f}s, {:.0f} events/s'.format(label, len(batch), elapsed, len(batch) / elapsed))
+
+
+def main():
+    # link previews would be fetched over the network
+    events.D_TASKS.pool.add = lambda *args: None
+    run('warm up', 1000000, 0)
+    try:
+        import bs4
+    except ImportError:
+        bs4 = None
+    if bs4 is not None:
+        current = events.strip_tags
+        events.strip_tags = bs4_strip_tags
+        run('BeautifulSoup strip_tags', 2000000, 1)
+        events.strip_tags = current
+    else:
+        print('beautifulsoup4 is not installed, skipping the BeautifulSoup run')
+    run('html.parser strip_tags', 3000000, 2)
+
+
+if __name__ == '__main__':
+    main()
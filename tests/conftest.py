@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+# bija.args parses the command line when it's imported, keep pytest's own options away from it
+# and point the app at a throwaway database
+sys.argv = [sys.argv[0], '--db', os.path.join(tempfile.mkdtemp(prefix='bija-tests-'), 'bija')]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    # clients that time out or stop reading early hang up mid response
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/slow':
+            time.sleep(1)
+            self.reply(b'late')
+        elif path == '/big':
+            self.reply(b'x' * 200000)
+        elif path == '/chunked':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for _ in range(20):
+                chunk = b'y' * 10000
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        elif path == '/drip':
+            # a few bytes at a time, each read finishes well inside the timeout
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', '100000')
+            self.end_headers()
+            for _ in range(20):
+                self.wfile.write(b'<!-- -->  ')
+                self.wfile.flush()
+                time.sleep(0.2)
+        elif path == '/untyped':
+            body = b'<html><head><meta property="og:title" content="Untyped"></head><body></body></html>'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/page':
+            self.reply(b'<html><head><meta property="og:title" content="Stub"></head><body></body></html>',
+                       'text/html; charset=utf-8')
+        else:
+            self.reply(b'{"names": {"bob": "abc"}}', 'application/json')
+
+    def reply(self, body, content_type='text/plain'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# a local http server for the outbound http tests, yields its base url
+@pytest.fixture(scope='module')
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://localhost:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
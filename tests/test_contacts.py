@@ -0,0 +1,59 @@
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from bija.db import BijaDB
+from bija.models import Base, Profile
+
+ME = 'a' * 64
+
+
+def key(i):
+    return '{:064x}'.format(i)
+
+
+# a BijaDB on an empty in-memory schema that records every statement it runs
+@pytest.fixture
+def db():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    statements = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    session = sessionmaker(bind=engine)()
+    bija_db = BijaDB(session)
+    bija_db.statements = statements
+    yield bija_db
+    session.close()
+
+
+def test_contacts_keep_list_order(db):
+    keys = [key(i) for i in (5, 1, 9, 3)]
+    db.session.add_all([Profile(public_key=k) for k in keys])
+    db.session.commit()
+    db.set_contacts(ME, keys + [keys[1]])
+    assert db.get_contacts(ME) == keys
+    assert [p.public_key for p in db.get_contact_profiles(ME)] == keys
+
+    reordered = [keys[2], keys[0], key(7), keys[3]]
+    added, removed = db.set_contacts(ME, reordered)
+    assert added == {key(7)}
+    assert removed == {keys[1]}
+    assert db.get_contacts(ME) == reordered
+    assert [p.public_key for p in db.get_contact_profiles(ME)] == [keys[2], keys[0], keys[3]]
+
+
+def test_removed_contacts_are_deleted_in_chunks(db):
+    keys = [key(i) for i in range(1200)]
+    db.set_contacts(ME, keys)
+    db.statements.clear()
+    added, removed = db.set_contacts(ME, keys[:10])
+    assert added == set()
+    assert len(removed) == 1190
+    deletes = [p for s, p in db.statements if s.startswith('DELETE FROM contact')]
+    assert len(deletes) == 3
+    assert max(len(p) for p in deletes) <= 501
+    assert db.get_contacts(ME) == keys[:10]
@@ -0,0 +1,19 @@
+from bija.helpers import normalize_url, url_link
+
+
+def test_normalize_url():
+    assert normalize_url(' HTTPS://Example.com:443/a?b=1#top ') == 'https://example.com/a?b=1'
+    assert normalize_url('http://example.com') == 'http://example.com/'
+    assert normalize_url('http://example.com:8080/x') == 'http://example.com:8080/x'
+
+
+def test_normalize_url_with_invalid_port():
+    assert normalize_url('https://Example.com:99999/page') == 'https://example.com:99999/page'
+    assert normalize_url('http://[::1/x') == 'http://[::1/x'
+
+
+def test_url_link():
+    assert url_link('https://example.com/a') == "<a href='https://example.com/a'>example.com/a</a>"
+    assert url_link('https://example.com/a/very/long/path') == \
+        "<a href='https://example.com/a/very/long/path'>example.com/a/very/lo&#8230;</a>"
+    assert url_link('example.com/a') == "<a href='https://example.com/a'>example.com/a</a>"
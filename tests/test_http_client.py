@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+import requests
+import urllib3.util.connection
+
+import bija.http_client
+from bija.http_client import HttpClient, ResponseTooLarge
+
+
+def test_get_reuses_connections(stub_server):
+    client = HttpClient()
+    for _ in range(10):
+        response, body = client.get(stub_server + '/.well-known/nostr.json', params={'name': 'bob'})
+        assert response.status_code == 200
+        assert body == b'{"names": {"bob": "abc"}}'
+    stats = client.stats()
+    assert stats['requests'] == 10
+    assert stats['connections'] == 1
+    assert stats['reuse'] == 0.9
+    assert stats['dns_misses'] == 1
+    assert stats['p99_ms'] >= stats['p50_ms']
+
+
+def test_timeout(stub_server):
+    client = HttpClient()
+    with pytest.raises(requests.Timeout):
+        client.get(stub_server + '/slow', timeout=0.2)
+    assert client.stats()['errors'] == 1
+
+
+def test_size_cap_by_content_length(stub_server):
+    client = HttpClient()
+    with pytest.raises(ResponseTooLarge):
+        client.get(stub_server + '/big', max_bytes=1000)
+
+
+def test_size_cap_while_streaming(stub_server):
+    client = HttpClient()
+    with pytest.raises(ResponseTooLarge):
+        client.get(stub_server + '/chunked', max_bytes=50000)
+    with client.stream(stub_server + '/chunked') as response:
+        body = b''.join(client.iter_body(response, 25000, 4096))
+    assert len(body) == 25000
+
+
+def test_content_type(stub_server):
+    client = HttpClient()
+    with client.stream(stub_server + '/page') as response:
+        assert client.content_type(response) == ('text/html', 'utf-8')
+    with client.stream(stub_server + '/untyped') as response:
+        assert client.content_type(response) == (None, None)
+
+
+# the body stops where it got to, or the read fails when the server framed it in chunks
+def test_deadline_cuts_slow_body(stub_server):
+    client = HttpClient()
+    started = time.monotonic()
+    body = b''
+    try:
+        with client.stream(stub_server + '/drip', timeout=1, deadline=0.6) as response:
+            body = b''.join(client.iter_body(response, chunk_size=4096))
+    except requests.RequestException:
+        pass
+    assert time.monotonic() - started < 1.5
+    assert len(body) < 100000
+    # later requests to the same host are unaffected
+    response, body = client.get(stub_server + '/.well-known/nostr.json')
+    assert body == b'{"names": {"bob": "abc"}}'
+
+
+def test_deadline_leaves_finished_response_alone(stub_server):
+    client = HttpClient()
+    for _ in range(3):
+        with client.stream(stub_server + '/page', deadline=0.05) as response:
+            body = b''.join(client.iter_body(response))
+        time.sleep(0.1)
+        assert b'og:title' in body
+    response, body = client.get(stub_server + '/.well-known/nostr.json')
+    assert response.status_code == 200
+
+
+# the dns cache is mounted on the client's session, other urllib3 users keep the default resolver
+def test_resolver_is_not_patched_globally():
+    create_connection = urllib3.util.connection.create_connection
+    HttpClient()
+    assert urllib3.util.connection.create_connection is create_connection
+
+
+# requests waiting on a slow host hold no global slot, so other hosts still get through
+def test_slow_host_does_not_starve_others(stub_server, monkeypatch):
+    monkeypatch.setattr(bija.http_client, 'HTTP_MAX_ACTIVE', 2)
+    monkeypatch.setattr(bija.http_client, 'HTTP_PER_HOST', 1)
+    client = HttpClient()
+    slow = [threading.Thread(target=client.get, args=(stub_server + '/slow',)) for _ in range(4)]
+    for t in slow:
+        t.start()
+    time.sleep(0.2)
+    started = time.monotonic()
+    response, body = client.get(stub_server.replace('localhost', '127.0.0.1') + '/.well-known/nostr.json')
+    assert response.status_code == 200
+    assert time.monotonic() - started < 0.5
+    for t in slow:
+        t.join()
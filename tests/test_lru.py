@@ -0,0 +1,35 @@
+from bija.lru import BoundedLRU
+from bija.note_html import NoteHtmlCache
+
+
+def test_evicts_least_recently_used():
+    removed = []
+    cache = BoundedLRU(2, on_remove=lambda k, v: removed.append(k))
+    cache.put({'a': 1, 'b': 2})
+    assert cache.get('a') == (True, 1)
+    cache.put({'c': 3})
+    assert removed == ['b']
+    assert cache.get('b') == (False, None)
+    assert cache.stats() == {'size': 2, 'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+
+
+def test_put_after_invalidation_is_dropped():
+    cache = BoundedLRU(10)
+    revision = cache.revision
+    cache.discard(['a'])
+    assert cache.put({'a': 'stale'}, revision) is False
+    assert 'a' not in cache
+    assert cache.put({'a': 'fresh'}, cache.revision) is True
+    assert cache.get('a') == (True, 'fresh')
+
+
+def test_note_html_indexes_follow_evictions():
+    cache = NoteHtmlCache(2)
+    for n in ['n1', 'n2', 'n3']:
+        cache.put((n, 200), '<p>{}</p>'.format(n), cache.revision, ['pk'])
+    assert cache.get(('n1', 200)) is None
+    assert set(cache.by_note) == {'n2', 'n3'}
+    assert cache.by_profile['pk'] == {('n2', 200), ('n3', 200)}
+    cache.discard_profiles(['pk'])
+    assert cache.stats()['size'] == 0
+    assert cache.by_note == {} and cache.by_profile == {}
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+import bija.app  # noqa: F401, db_writer needs the app to be set up first
+import bija.nip05 as nip05
+from bija.nip05 import Nip05Verifier
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    calls = []
+    listing = {'alice': 'pk-alice', 'bob': 'pk-bob'}
+
+    def request_nip05_names(domain, name=None):
+        calls.append((domain, name))
+        if name is None:
+            return dict(listing)
+        return {name: listing[name]} if name in listing else {}
+
+    monkeypatch.setattr(nip05, 'request_nip05_names', request_nip05_names)
+    monkeypatch.setattr(nip05, 'NIP05_BATCH_DELAY', 0.05)
+    writes = []
+    monkeypatch.setattr(nip05.DB_WRITER, 'submit', lambda *args: writes.append(args))
+    return calls, listing, writes
+
+
+def test_domain_batch(lookups):
+    calls, listing, writes = lookups
+    v = Nip05Verifier(2, 100)
+    assert v.verify('alice@example.com', 'pk-alice') is None
+    assert v.verify('bob@Example.com', 'wrong') is None
+    assert v.verify('carol@example.com', 'pk-carol') is None
+    time.sleep(0.3)
+    assert calls == [('example.com', None), ('example.com', 'carol')]
+    assert sorted(w[1:] for w in writes) == [
+        ('pk-alice', 'alice@example.com', True),
+        ('pk-carol', 'carol@example.com', False),
+        ('wrong', 'bob@Example.com', False)
+    ]
+    assert v.verify('alice@example.com', 'pk-alice') is True
+    assert v.verify('carol@example.com', 'pk-carol') is False
+    assert len(calls) == 2
+
+
+def test_cache_is_capped(lookups):
+    v = Nip05Verifier(1, 3)
+    for name in ['a', 'b', 'c', 'd', 'e']:
+        v.resolve('{}@example.com'.format(name))
+    assert v.stats()['size'] == 3
+
+
+def test_resolve_retries_cached_misses(lookups):
+    calls, listing, writes = lookups
+    v = Nip05Verifier(1, 100)
+    assert v.resolve('carol@example.com') is None
+    listing['carol'] = 'pk-carol'
+    assert v.resolve('carol@example.com') == 'pk-carol'
+    assert v.resolve('carol@example.com') == 'pk-carol'
+    assert len(calls) == 2
@@ -0,0 +1,18 @@
+import time
+
+import bija.app
+import bija.deferred_tasks as deferred_tasks
+from bija.deferred_tasks import OGTags
+
+
+def test_page_without_content_type(stub_server):
+    tags = OGTags({'url': stub_server + '/untyped', 'note_id': 'a' * 64})
+    assert tags.og['title'] == 'Untyped'
+
+
+def test_slow_page_stops_at_deadline(stub_server, monkeypatch):
+    monkeypatch.setattr(deferred_tasks, 'OG_READ_DEADLINE', 0.6)
+    started = time.monotonic()
+    tags = OGTags({'url': stub_server + '/drip', 'note_id': 'a' * 64})
+    assert time.monotonic() - started < 1.5
+    assert tags.og == {}
@@ -0,0 +1,42 @@
+from bija.profile_briefs import ProfileBriefs
+
+
+class FakeDB:
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.loads = 0
+        self.name = 'old'
+
+    def get_profile_briefs(self, public_keys):
+        self.loads += 1
+        rows = [{'public_key': k, 'name': self.name} for k in public_keys]
+        if self.cache is not None:
+            # the writer commits a new name and drops the brief while this read is in flight
+            self.name = 'new'
+            self.cache.discard(public_keys)
+            self.cache = None
+        return rows
+
+
+def test_briefs_are_cached():
+    cache = ProfileBriefs(10)
+    db = FakeDB()
+    assert cache.get(db, ['a', 'b'])['a']['name'] == 'old'
+    cache.get(db, ['a', 'b'])
+    assert db.loads == 1
+    assert cache.stats()['hits'] == 2
+
+
+def test_discard_during_load_is_not_overwritten():
+    cache = ProfileBriefs(10)
+    db = FakeDB(cache)
+    assert cache.get(db, ['a'])['a']['name'] == 'old'
+    assert cache.get(db, ['a'])['a']['name'] == 'new'
+    assert db.loads == 2
+
+
+def test_size_limit():
+    cache = ProfileBriefs(2)
+    db = FakeDB()
+    cache.get(db, ['a', 'b', 'c'])
+    assert cache.stats()['size'] == 2
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from bija.db import BijaDB
+from bija.models import Base
+
+ME = 'a' * 64
+
+
+# a BijaDB on an empty in-memory schema that records every statement it runs
+@pytest.fixture
+def db():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    statements = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith('EXPLAIN'):
+            statements.append((statement, parameters))
+
+    session = sessionmaker(bind=engine)()
+    bija_db = BijaDB(session)
+    bija_db.statements = statements
+    yield bija_db
+    session.close()
+
+
+def plan(db, call):
+    db.statements.clear()
+    call()
+    statement, parameters = db.statements[-1]
+    rows = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    return [r[3] for r in rows]
+
+
+def assert_no_scan(steps, *tables):
+    for step in steps:
+        for table in tables:
+            assert not step.startswith('SCAN {}'.format(table)) or 'COVERING INDEX' in step, steps
+
+
+def test_feed_reads_the_timeline_index(db):
+    steps = plan(db, lambda: db.get_feed(time.time()))
+    assert any('timeline' in s and 'ix_timeline_created_at_note_id' in s for s in steps), steps
+    assert_no_scan(steps, 'note', 'profile')
+
+
+def test_feed_keyset_page(db):
+    steps = plan(db, lambda: db.get_feed(1000, 'f' * 64))
+    assert any('ix_timeline_created_at_note_id' in s for s in steps), steps
+    assert_no_scan(steps, 'note', 'profile')
+
+
+def test_unseen_in_feed_uses_seen_index(db):
+    steps = plan(db, lambda: db.get_unseen_in_feed(ME))
+    assert any('ix_note_seen_public_key' in s for s in steps), steps
+    assert_no_scan(steps, 'note', 'timeline')
+
+
+def test_notes_by_pubkey_use_author_index(db):
+    steps = plan(db, lambda: db.get_notes_by_pubkey(ME, time.time(), 0))
+    assert any('ix_note_public_key_created_at' in s for s in steps), steps
+    assert_no_scan(steps, 'note')
+
+
+def test_thread_uses_reply_indexes(db):
+    steps = plan(db, lambda: db.get_note_thread_ids('b' * 64))
+    assert any('ix_note_response_to' in s for s in steps), steps
+    assert any('ix_note_thread_root' in s for s in steps), steps
@@ -0,0 +1,17 @@
+import json
+import os
+
+import pytest
+
+from bija.helpers import strip_tags
+
+# note contents with the text BeautifulSoup(content, features="html.parser").get_text() gave for them,
+# single samples first, then samples joined together so tags and entities are cut and mixed the way
+# long notes mix them
+with open(os.path.join(os.path.dirname(__file__), 'data', 'strip_tags.json'), encoding='utf-8') as f:
+    SAMPLES = json.load(f)
+
+
+@pytest.mark.parametrize('sample', SAMPLES, ids=range(len(SAMPLES)))
+def test_matches_beautifulsoup_text(sample):
+    assert strip_tags(sample['content']) == sample['text']
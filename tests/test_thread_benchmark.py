@@ -0,0 +1,85 @@
+import gc
+import json
+import time
+
+import bija.app
+import bija.routes as routes
+from bija.db import DB_ENGINE
+from bija.models import Note, Profile
+from bija.note_html import NOTE_HTML
+from bija.settings import Settings
+
+REPLIES = 5000
+# seconds for the 5,000 reply pages, a few times what they take here: the root shows one reply,
+# the deepest reply renders every note above it
+ROOT_BUDGET = 1
+CHAIN_BUDGET = 4
+# rendering four times the replies may take at most this many times longer, quadratic assembly takes about sixteen
+GROWTH = 8
+
+ME = 'e' * 64
+AUTHORS = ['{:064x}'.format(0xa000 + i) for i in range(50)]
+
+
+def note_id(thread, i):
+    return '{:x}{:063x}'.format(thread, i)
+
+
+# a linear chain, every reply answers the one before it, returns the root and the deepest reply
+def fill_chain(thread, replies):
+    notes = []
+    for i in range(replies + 1):
+        notes.append({
+            'id': note_id(thread, i),
+            'public_key': AUTHORS[i % len(AUTHORS)],
+            'content': 'reply {} nostr:npub'.format(i),
+            'response_to': note_id(thread, i - 1) if i > 0 else None,
+            'thread_root': note_id(thread, 0) if i > 0 else None,
+            'created_at': 1 + i,
+            'members': json.dumps([AUTHORS[(i + 1) % len(AUTHORS)]]),
+            'media': '[]',
+            'seen': False
+        })
+    with DB_ENGINE.begin() as connection:
+        connection.execute(Note.__table__.insert(), notes)
+    return note_id(thread, 0), note_id(thread, replies)
+
+
+# best of a few runs, each renders the note content afresh so a chain that fits the html cache isn't favoured
+def render(client, note, runs=3):
+    best = None
+    for _ in range(runs):
+        NOTE_HTML.clear()
+        gc.collect()
+        started = time.perf_counter()
+        response = client.get('/note', query_string={'id': note})
+        elapsed = time.perf_counter() - started
+        assert response.status_code == 200
+        best = elapsed if best is None else min(best, elapsed)
+    return response.get_data(as_text=True), best
+
+
+def test_render_long_reply_chain(monkeypatch):
+    with DB_ENGINE.begin() as connection:
+        connection.execute(Profile.__table__.insert(), [{'public_key': k, 'name': k[-4:]} for k in AUTHORS])
+    monkeypatch.setitem(Settings.items, 'keys', {'public': ME, 'private': 'f' * 64})
+    monkeypatch.setattr(routes.EXECUTOR, 'submit', lambda *args, **kwargs: None)
+    client = bija.app.app.test_client()
+
+    roots = {}
+    lasts = {}
+    for thread, replies in ((1, REPLIES // 4), (2, REPLIES)):
+        root, last = fill_chain(thread, replies)
+        # the root loads the whole chain below it to find its replies
+        html, roots[replies] = render(client, root)
+        assert html.count('class="note-container reply"') == 1
+        # the deepest reply walks the whole chain up to the root and shows every note on the way
+        html, lasts[replies] = render(client, last)
+        assert html.count('class="note-container ancestor"') == replies - 1
+        assert 'data-id="{}"'.format(root) in html
+        print('\n{} replies, root: {:.3f}s, deepest reply: {:.3f}s'.format(replies, roots[replies], lasts[replies]))
+
+    assert roots[REPLIES] < ROOT_BUDGET
+    assert lasts[REPLIES] < CHAIN_BUDGET
+    for times in (roots, lasts):
+        assert times[REPLIES] < GROWTH * times[REPLIES // 4]